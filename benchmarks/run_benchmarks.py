@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+@brief: Runs download_data_local.py-style flows (build the data request urls from the GUI data catalog, send the
+requests, wait for them to fulfill and download the files, then download the annotations) against the local stand-in
+server in standin_server.py, and reports the wall time and throughput of each step. Nothing is sent to the OOI
+servers, so performance changes can be measured offline and repeated at any scale, latency and failure rate.
+
+@usage (from the top directory of the repository):
+python -m benchmarks.run_benchmarks --streams 50 --files 3 --file-size 1000000 --fulfill-delay 2 --failure-rate 0.1
+python -m benchmarks.run_benchmarks --help lists all of the options. --flow pipeline (default) sends, polls and
+downloads as one pipeline (pipeline_nc.py), --flow sequential sends every request, waits for all of them and then
+downloads them, and --flow both runs one after the other. The report is printed and saved as benchmark_<now>.json in
+the output directory (a new temporary directory by default).
+"""
+
+import argparse
+import datetime as dt
+import json
+import os
+import tempfile
+import time
+from .standin_server import StandInServer
+
+
+def main(flow='pipeline', n_streams=20, files_per_request=3, file_size=1000000, latency=0.0, submit_latency=0.0,
+         fulfill_delay=2.0, failure_rate=0.0, bandwidth=None, n_annotations=200, n_send=5, n_download=2,
+         poll_wait=0.5, retry_wait=0.5, outDir=None, seed=0, catalog_split=None):
+    outDir = outDir or tempfile.mkdtemp(prefix='ooi_benchmark_')
+    standin = StandInServer(n_streams, files_per_request, file_size, latency, submit_latency, fulfill_delay,
+                            failure_rate, bandwidth, n_annotations, seed, catalog_split=catalog_split).start()
+
+    # point the scripts at the stand-in server, this has to happen before functions.common is imported
+    os.environ['OOI_M2M_URL'] = standin.url
+    os.environ['OOI_OPENDAP_URL'] = standin.url
+    os.environ['OOI_DATA_CACHE'] = os.path.join(outDir, 'cache')
+    import functions.common as cf
+    from functions import metrics
+    import scripts
+
+    if cf.M2M_URL != standin.url:
+        raise Exception('functions.common was imported before the benchmark started, run it in a new python process')
+
+    flows = ['pipeline', 'sequential'] if flow == 'both' else [flow]
+    now = dt.datetime.now().strftime('%Y%m%dT%H%M%S')
+    report = dict(run=now, outDir=outDir, server=dict(n_streams=n_streams, files_per_request=files_per_request,
+                                                      file_size=file_size, latency=latency,
+                                                      submit_latency=submit_latency, fulfill_delay=fulfill_delay,
+                                                      failure_rate=failure_rate, bandwidth=bandwidth,
+                                                      n_annotations=n_annotations, catalog_split=catalog_split),
+                  settings=dict(n_send=n_send, n_download=n_download, poll_wait=poll_wait, retry_wait=retry_wait),
+                  flows=dict())
+    try:
+        for name in flows:
+            sDir = os.path.join(outDir, name)
+            cf.create_dir(sDir)
+            metrics.reset()
+            counts = dict(standin.counts)
+            steps = dict()
+
+            stime = time.time()
+            url_list = scripts.data_request_urls_nocheck.main(sDir, [], [], [], [], [], '', '', now,
+                                                              refresh_catalog=True)
+            steps['plan'] = time.time() - stime
+
+            stime = time.time()
+            if name == 'pipeline':
+                scripts.pipeline_nc.main(sDir, url_list, 'benchmark', 'benchmark', now, n_send, n_download,
+                                         poll_wait=poll_wait, retry_wait=retry_wait, confirm=False)
+            else:
+                thredds_urls = scripts.send_data_requests_nc.main(sDir, url_list, 'benchmark', 'benchmark', now,
+                                                                  n_send, retry_wait=retry_wait, confirm=False)
+                steps['send'] = time.time() - stime
+                cf.wait_for_requests(thredds_urls, initial_wait=poll_wait)
+                steps['wait'] = time.time() - stime - steps['send']
+                session = cf.get_session(pool_size=4)
+                for url, t in zip(url_list, thredds_urls):
+                    if 'no_output_url' not in t:
+                        scripts.thredds_download_nc.download_request(sDir, t, session, request_url=url)
+                steps['download'] = time.time() - stime - steps['send'] - steps['wait']
+            steps['data_requests'] = time.time() - stime
+
+            stime = time.time()
+            scripts.m2m_get_annotations.main('benchmark', 'benchmark', '', os.path.join(sDir, 'annotations'))
+            steps['annotations'] = time.time() - stime
+
+            counts = dict((k, standin.counts[k] - counts[k]) for k in counts)
+            wall_time = sum(v for k, v in steps.items() if k in ('plan', 'data_requests', 'annotations'))
+            report['flows'][name] = dict(
+                wall_time=wall_time, steps=steps, server_counts=counts, requests=len(url_list),
+                requests_per_second=len(url_list) / max(steps['data_requests'], 1e-6),
+                download_mb_per_second=counts['bytes'] / 1e6 / max(steps['data_requests'], 1e-6),
+                metrics=metrics.write_run(sDir, now))
+    finally:
+        standin.stop()
+
+    fpath = os.path.join(outDir, 'benchmark_{}.json'.format(now))
+    with open(fpath, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print_report(report)
+    print('\nBenchmark report saved to {}'.format(fpath))
+    return report
+
+
+def print_report(report):
+    print('\nBenchmark settings: {}'.format(', '.join('{}={}'.format(k, v) for k, v in
+                                                      sorted(dict(report['server'], **report['settings']).items()))))
+    for name, r in report['flows'].items():
+        print('\n{} flow: {:.2f} seconds for {} data requests'.format(name, r['wall_time'], r['requests']))
+        for step in ('plan', 'send', 'wait', 'download', 'data_requests', 'annotations'):
+            if step in r['steps']:
+                print('  {:<14s} {:8.2f} s'.format(step, r['steps'][step]))
+        print('  {:.2f} requests/s, {:.2f} MB/s downloaded, {} requests rejected and re-sent, {} status checks'.format(
+            r['requests_per_second'], r['download_mb_per_second'], r['server_counts']['rejected'],
+            r['server_counts']['status_checks']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the data download scripts against a local stand-in of '
+                                                 'the OOI M2M and THREDDS servers.')
+    parser.add_argument('--flow', choices=['pipeline', 'sequential', 'both'], default='pipeline')
+    parser.add_argument('--streams', type=int, default=20, help='number of streams in the data catalog')
+    parser.add_argument('--files', type=int, default=3, help='netCDF files per data request')
+    parser.add_argument('--file-size', type=float, default=1e6, help='bytes per netCDF file')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--submit-latency', type=float, default=0.0, help='extra seconds to accept a data request')
+    parser.add_argument('--fulfill-delay', type=float, default=2.0, help='mean seconds for a data request to fulfill')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of data requests rejected')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second per download')
+    parser.add_argument('--annotations', type=int, default=200, help='number of annotations')
+    parser.add_argument('--n-send', type=int, default=5, help='data requests in flight at once')
+    parser.add_argument('--n-download', type=int, default=2, help='fulfilled requests downloaded at once')
+    parser.add_argument('--poll-wait', type=float, default=0.5, help='initial seconds between status checks')
+    parser.add_argument('--retry-wait', type=float, default=0.5, help='seconds before a rejected request is re-sent')
+    parser.add_argument('--out', default=None, help='output directory (default: a new temporary directory)')
+    parser.add_argument('--catalog-split', type=int, default=None, help='files per THREDDS sub-catalog')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    main(args.flow, args.streams, args.files, args.file_size, args.latency, args.submit_latency, args.fulfill_delay,
+         args.failure_rate, args.bandwidth, args.annotations, args.n_send, args.n_download, args.poll_wait,
+         args.retry_wait, args.out, args.seed, args.catalog_split)
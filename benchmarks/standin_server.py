@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""
+@brief: A local stand-in for the parts of the OOI M2M and THREDDS servers used by this repository, so the whole
+pipeline can be run and measured offline. It serves a synthetic GUI data catalog (/api/uframe/stream), the sensor
+inventory and data request endpoints (/api/m2m/12576/sensor/inv), status.txt files that appear fulfill_delay seconds
+after a request is sent, THREDDS catalog.xml files, fileServer downloads (with HEAD and Range support) and the
+annotation endpoints (/api/m2m/12580/anno). Point the scripts at it by setting the OOI_M2M_URL and OOI_OPENDAP_URL
+environment variables to its url before functions.common is imported (see run_benchmarks.py).
+
+@usage:
+n_streams: number of streams in the data catalog (every third one is an engineering stream)
+files_per_request: number of netCDF files in each fulfilled data request (plus a provenance and an annotation file)
+file_size: size of each netCDF file in bytes
+latency: seconds added to every response
+submit_latency: extra seconds uFrame takes to accept a data request
+fulfill_delay: mean seconds before a data request fulfills (each request takes 0.5 to 1.5 times as long)
+failure_rate: fraction of data requests rejected with a 400 (uFrame busy), the scripts re-send those
+bandwidth: optional bytes per second per download, unlimited by default
+n_annotations: number of annotations
+catalog_split: optional number of files per THREDDS sub-catalog, the catalog.xml of a request then only holds
+catalogRef entries to its sub-catalogs (catalog_1.xml, catalog_2.xml, ...)
+"""
+
+import json
+import random
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+LAST_MODIFIED = formatdate(1767225600, usegmt=True)  # 2026-01-01
+BLOCK = bytes(range(256)) * 4096  # file contents are this 1 MB block repeated
+
+
+class StandInServer(object):
+
+    def __init__(self, n_streams=20, files_per_request=3, file_size=1000000, latency=0.0, submit_latency=0.0,
+                 fulfill_delay=2.0, failure_rate=0.0, bandwidth=None, n_annotations=200, seed=0, host='127.0.0.1',
+                 port=0, catalog_split=None):
+        self.files_per_request = files_per_request
+        self.catalog_split = catalog_split
+        self.file_size = int(file_size)
+        self.latency = latency
+        self.submit_latency = submit_latency
+        self.fulfill_delay = fulfill_delay
+        self.failure_rate = failure_rate
+        self.bandwidth = bandwidth
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = dict()  # folder: time the request fulfills
+        self.counts = dict(data_requests=0, rejected=0, status_checks=0, files=0, bytes=0)
+        self.streams = make_streams(n_streams)
+        self.catalog = json.dumps(dict(streams=self.streams)).encode('utf-8')
+        self.annotations = make_annotations(self.streams, n_annotations, self.random)
+        self.inventory = dict()
+        for s in self.streams:
+            subsite, node, sensor = s['reference_designator'].split('-', 2)
+            methods = self.inventory.setdefault(subsite, dict()).setdefault(node, dict()).setdefault(sensor, dict())
+            methods.setdefault(s['stream_method'].replace('-', '_'), []).append(s['stream'])
+        self.server = None
+        self.url = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.server.standin = self
+        self.url = 'http://{}:{}'.format(*self.server.server_address[:2])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep connections alive like the real servers
+    disable_nagle_algorithm = True  # headers and body are written separately, don't hold small responses back
+
+    def do_GET(self):
+        self.route(head=False)
+
+    def do_HEAD(self):
+        self.route(head=True)
+
+    def log_message(self, *args):
+        pass
+
+    def route(self, head):
+        standin = self.server.standin
+        if standin.latency:
+            time.sleep(standin.latency)
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/')
+        if path == '/api/uframe/stream':
+            self.catalog(standin)
+        elif path.startswith('/api/m2m/12576/sensor/inv'):
+            self.inventory(standin, [p for p in path.split('/')[6:] if p])
+        elif path.startswith('/api/m2m/12580/anno'):
+            self.annotations(standin, path.split('/')[5:], url.query)
+        elif path.startswith('/thredds/catalog/') and path.endswith('.xml'):
+            self.thredds_catalog(standin, path.split('/')[-2], path.split('/')[-1])
+        elif path.startswith('/thredds/fileServer/') and path.endswith('/status.txt'):
+            self.status(standin, path.split('/')[-2])
+        elif path.startswith('/thredds/fileServer/'):
+            self.file(standin, path.split('/')[-2], path.split('/')[-1], head)
+        else:
+            self.send_body(404, b'Not found', 'text/plain')
+
+    def send_body(self, code, body, content_type='application/json', headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_json(self, obj, code=200):
+        self.send_body(code, json.dumps(obj).encode('utf-8'))
+
+    def annotations(self, standin, parts, query):
+        if not parts:  # anno?max_100&select_id&start_id=
+            start_id = int(parse_qs(query).get('start_id', ['0'])[0])
+            self.send_json([a['id'] for a in standin.annotations if a['id'] >= start_id][:100])
+        elif parts[0] == 'find':
+            refdes = parse_qs(query).get('refdes', [''])[0]
+            self.send_json([a for a in standin.annotations if a['refdes'].startswith(refdes)])
+        elif parts[0].isdigit() and 0 < int(parts[0]) <= len(standin.annotations):
+            self.send_json(standin.annotations[int(parts[0]) - 1])
+        else:
+            self.send_json(dict(message='Annotation not found'), 404)
+
+    def catalog(self, standin):
+        if self.headers.get('If-None-Match') == '"catalog"':
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_body(200, standin.catalog, headers=[('ETag', '"catalog"'), ('Last-Modified', LAST_MODIFIED)])
+
+    def data_request(self, standin, refdes, method, stream):
+        if standin.submit_latency:
+            time.sleep(standin.submit_latency)
+        with standin.lock:
+            rejected = standin.random.random() < standin.failure_rate
+            delay = standin.fulfill_delay * standin.random.uniform(0.5, 1.5)
+            standin.counts['data_requests'] += 1
+        if rejected:
+            standin.count('rejected')
+            self.send_json(dict(message=dict(code=400, status='The server is busy, try again later')), 400)
+            return
+
+        with standin.lock:
+            folder = '{}r{:06d}-{}-{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), len(standin.requests), refdes, method,
+                                                 stream)
+            standin.requests[folder] = time.time() + delay
+        output_url = '{}/thredds/catalog/ooi/user/{}/catalog.html'.format(standin.url, folder)
+        self.send_json(dict(requestUUID=folder, outputURL=output_url, allURLs=[output_url],
+                            sizeCalculation=standin.files_per_request * standin.file_size, timeCalculation=delay,
+                            numberOfSubJobs=1))
+
+    def file(self, standin, folder, name, head):
+        if folder not in standin.requests or name not in file_names(folder, standin.files_per_request):
+            self.send_body(404, b'Not found', 'text/plain')
+            return
+        size = standin.file_size if name.endswith('.nc') else 1000
+        start = 0
+        rng = self.headers.get('Range')
+        if rng and not head and self.headers.get('If-Range', LAST_MODIFIED) == LAST_MODIFIED:
+            start = int(rng.split('=')[1].split('-')[0])
+            if start >= size:
+                self.send_body(416, b'', 'text/plain', [('Content-Range', 'bytes */{}'.format(size))])
+                return
+
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size - start))
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.send_header('Accept-Ranges', 'bytes')
+        if start:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, size - 1, size))
+        self.end_headers()
+        if head:
+            return
+        pos = start
+        while pos < size:
+            offset = pos % len(BLOCK)
+            chunk = BLOCK[offset:offset + min(size - pos, 256 * 1024)]
+            self.wfile.write(chunk)
+            pos += len(chunk)
+            if standin.bandwidth:
+                time.sleep(len(chunk) / standin.bandwidth)
+        standin.count('files')
+        standin.count('bytes', size - start)
+
+    def inventory(self, standin, parts):
+        node = standin.inventory
+        for p in parts[:4]:
+            node = node.get(p) if isinstance(node, dict) else None
+            if node is None:
+                self.send_json(dict(message='Not found'), 404)
+                return
+        if len(parts) == 5:
+            refdes = '-'.join(parts[:3])
+            self.data_request(standin, refdes, parts[3], parts[4])
+        else:
+            self.send_json(sorted(node))
+
+    def status(self, standin, folder):
+        standin.count('status_checks')
+        fulfills = standin.requests.get(folder)
+        if fulfills is None or time.time() < fulfills:
+            self.send_body(404, b'Not found', 'text/plain')
+        else:
+            self.send_body(200, b'Complete', 'text/plain')
+
+    def thredds_catalog(self, standin, folder, catalog):
+        names = file_names(folder, standin.files_per_request)
+        split = standin.catalog_split
+        if folder not in standin.requests or (catalog != 'catalog.xml' and not split):
+            self.send_body(404, b'Not found', 'text/plain')
+            return
+        datasets = []
+        if split and catalog == 'catalog.xml':
+            names = []
+            for k in range(1, (standin.files_per_request + 2 - 1) // split + 2):
+                datasets.append('    <catalogRef xlink:href="catalog_{0}.xml" xlink:title="part {0}" '
+                                'name="" />\n'.format(k))
+        elif split:
+            k = int(catalog[len('catalog_'):-len('.xml')])
+            names = names[(k - 1) * split:k * split]
+        for name in names:
+            size = standin.file_size if name.endswith('.nc') else 1000
+            datasets.append('    <dataset name="{0}" ID="ooi/user/{1}/{0}" urlPath="ooi/user/{1}/{0}">\n'
+                            '      <dataSize units="bytes">{2}</dataSize>\n'
+                            '      <date type="modified">2026-01-01T00:00:00Z</date>\n'
+                            '    </dataset>\n'.format(name, folder, size))
+        xml = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<catalog xmlns="http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0" '
+               'xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.1">\n'
+               '  <service name="all" serviceType="Compound" base="" />\n'
+               '  <dataset name="{0}" ID="ooi/user/{0}">\n{1}  </dataset>\n'
+               '</catalog>\n'.format(folder, ''.join(datasets)))
+        self.send_body(200, xml.encode('utf-8'), 'application/xml')
+
+
+def file_names(folder, files_per_request):
+    refdes_stream = folder.split('-', 1)[1]
+    names = ['deployment{:04d}_{}_2015{:02d}01T000000-2015{:02d}01T000000.nc'.format(1 + i // 11, refdes_stream,
+                                                                                 1 + i % 11, 2 + i % 11)
+             for i in range(files_per_request)]
+    names.append('deployment0001_{}_provenance.json'.format(refdes_stream))
+    names.append('deployment0001_{}_annotations.json'.format(refdes_stream))
+    return names
+
+
+def make_annotations(streams, n_annotations, rnd):
+    annotations = []
+    for i in range(n_annotations):
+        s = streams[rnd.randrange(len(streams))]
+        subsite, node, sensor = s['reference_designator'].split('-', 2)
+        begin = 1420070400000 + rnd.randrange(365) * 86400000  # in 2015
+        annotations.append(dict(id=i + 1, refdes=s['reference_designator'], subsite=subsite, node=node, sensor=sensor,
+                                stream=s['stream'], method=s['stream_method'], parameters=[], beginDT=begin,
+                                endDT=begin + 86400000 * rnd.randrange(1, 30) if i % 5 else None,
+                                exclusionFlag=False, qcFlag=None, source='benchmark',
+                                annotation='Benchmark annotation {}'.format(i + 1)))
+    return annotations
+
+
+def make_streams(n_streams):
+    streams = []
+    for i in range(n_streams):
+        refdes = 'BM{:02d}SUMO-SBD{:02d}-{:02d}-CTDBPA{:03d}'.format(i % 4 + 1, i % 3 + 11, i % 8 + 1, i)
+        streams.append(dict(array_name='Benchmark Array', reference_designator=refdes,
+                            stream_method=['telemetered', 'recovered-host', 'streamed'][i % 3],
+                            stream='ctdbp_sample_{}'.format(i), stream_name='ctdbp_sample_{}'.format(i),
+                            stream_dataset='Engineering' if i % 3 == 2 else 'Science',
+                            start='2015-01-01T00:00:00.000Z', end='2016-01-01T00:00:00.000Z'))
+    return streams
+
+
+if __name__ == '__main__':
+    with StandInServer(n_streams=20, fulfill_delay=5) as standin:
+        print('Serving the OOI stand-in at {} (press Ctrl-C to stop)'.format(standin.url))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
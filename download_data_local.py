@@ -11,37 +11,68 @@ provenance, and annotation files to a local machine.
 sDir: directory where outputs are saved
 username: OOI API username
 token: OOI API password
+chunk_days: optional, split each data request into equal time windows of at most this many days (e.g. 90) so the
+pieces fulfill in parallel. Streamed data get windows a tenth as long (e.g. 9 days for 90)
+pipeline: optional, if True download each request as soon as it fulfills while the remaining requests are still
+being sent and fulfilled (default False: send every request, then wait for and download them)
+resume: if True, skip the prompts and pick up the most recent run in sDir from its request journal without re-sending
+requests that were already sent
+consolidate: if True, consolidate the downloaded netCDF files of each stream into a Zarr store in sDir/zarr (requires
+xarray and zarr)
+profile: if True, run each stage under cProfile. Timing and throughput metrics of every run are saved in sDir as
+metrics_<now>.json and metrics_<now>.prom, and the profiles as profile_<now>_<stage>.prof
 """
 
 import datetime as dt
 import functions.common as cf
+from functions import journal
+from functions import metrics
 import scripts
 
 sDir = '/Users/lgarzio/Documents/OOI'
 username = 'username'
 token = 'token'
+chunk_days = None
+pipeline = False
+resume = False
+consolidate = False
+profile = False
 
 cf.create_dir(sDir)
+metrics.enable_profiling(profile)
 now = dt.datetime.now().strftime('%Y%m%dT%H%M')
 
-arrays = input('\nPlease select arrays (CE, CP, GA, GI, GP, GS, RS). Must be comma separated (if choosing multiple) or press enter to select all: ') or ''
-array = scripts.data_request_tools.format_inputs(arrays)
+if resume:
+    now = journal.latest_run(sDir)
+    url_list = None
+else:
+    arrays = input('\nPlease select arrays (CE, CP, GA, GI, GP, GS, RS). Must be comma separated (if choosing multiple) or press enter to select all: ') or ''
+    array = scripts.data_request_tools.format_inputs(arrays)
 
-subsites = input('\nPlease fully-qualified subsites (e.g. GI01SUMO, GI05MOAS). Must be comma separated (if choosing multiple) or press enter to select all: ') or ''
-subsite = scripts.data_request_tools.format_inputs(subsites)
+    subsites = input('\nPlease fully-qualified subsites (e.g. GI01SUMO, GI05MOAS). Must be comma separated (if choosing multiple) or press enter to select all: ') or ''
+    subsite = scripts.data_request_tools.format_inputs(subsites)
 
-nodes = input('\nPlease select fully-qualified nodes. (e.g. GL469, GL477). Must be comma separated (if choosing multiple) or press enter to select all: ') or ''
-node = scripts.data_request_tools.format_inputs(nodes)
+    nodes = input('\nPlease select fully-qualified nodes. (e.g. GL469, GL477). Must be comma separated (if choosing multiple) or press enter to select all: ') or ''
+    node = scripts.data_request_tools.format_inputs(nodes)
 
-insts = input('\nPlease select instruments (can be partial (e.g. CTD) or fully-qualified (e.g. 04-CTDGVM000)). Must be comma separated (if choosing multiple) or press enter to select all: ') or ''
-inst = scripts.data_request_tools.format_inputs(insts)
+    insts = input('\nPlease select instruments (can be partial (e.g. CTD) or fully-qualified (e.g. 04-CTDGVM000)). Must be comma separated (if choosing multiple) or press enter to select all: ') or ''
+    inst = scripts.data_request_tools.format_inputs(insts)
 
-delivery_methods = input('\nPlease select valid delivery methods [recovered, telemetered, streamed]. Must be comma separated (if choosing multiple) or press enter to select all: ') or ''
+    delivery_methods = input('\nPlease select valid delivery methods [recovered, telemetered, streamed]. Must be comma separated (if choosing multiple) or press enter to select all: ') or ''
 
-begin = input('Please enter a start date for your data requests with format <2014-01-01T00:00:00> or press enter to request all available data: ') or ''
-end = input('Please enter an end date for your data requests with format <2014-01-01T00:00:00> or press enter to request all available data: ') or ''
+    begin = input('Please enter a start date for your data requests with format <2014-01-01T00:00:00> or press enter to request all available data: ') or ''
+    end = input('Please enter an end date for your data requests with format <2014-01-01T00:00:00> or press enter to request all available data: ') or ''
 
-url_list = scripts.data_request_urls_nocheck.main(sDir, array, subsite, node, inst, delivery_methods, begin, end, now)
-thredds_urls = scripts.send_data_requests_nc.main(sDir, url_list, username, token, now)
+    url_list = scripts.data_request_urls_nocheck.main(sDir, array, subsite, node, inst, delivery_methods, begin, end, now,
+                                                      chunk_days=chunk_days)
 
-scripts.thredds_download_nc.main(sDir, thredds_urls)
+if pipeline:
+    scripts.pipeline_nc.main(sDir, url_list, username, token, now, resume=resume)
+else:
+    thredds_urls = scripts.send_data_requests_nc.main(sDir, url_list, username, token, now, resume=resume)
+    scripts.thredds_download_nc.main(sDir, thredds_urls, now=now)
+
+if consolidate:
+    scripts.consolidate_zarr.main(sDir)
+
+metrics.write_run(sDir, now)
@@ -11,29 +11,46 @@ urls, and sends those requests (if prompted).
 sDir: directory where outputs are saved
 username: OOI API username
 token: OOI API password
+chunk_days: optional, split each data request into equal time windows of at most this many days (e.g. 90) so the
+pieces fulfill in parallel. Streamed data get windows a tenth as long (e.g. 9 days for 90)
+resume: if True, skip the prompts and pick up the most recent run in sDir from its request journal without re-sending
+requests that were already sent
+profile: if True, run each stage under cProfile. Timing and throughput metrics of every run are saved in sDir as
+metrics_<now>.json and metrics_<now>.prom, and the profiles as profile_<now>_<stage>.prof
 """
 
 import datetime as dt
 import functions.common as cf
+from functions import journal
+from functions import metrics
 import scripts
 
 sDir = '/Users/lgarzio/Documents/OOI'
 username = 'username'
 token = 'token'
+chunk_days = None
+resume = False
+profile = False
 
 cf.create_dir(sDir)
+metrics.enable_profiling(profile)
 now = dt.datetime.now().strftime('%Y%m%dT%H%M')
 
-array, subsite, node, inst, delivery_methods = scripts.interactive_inputs.return_interactive_inputs()
+if resume:
+    now = journal.latest_run(sDir)
+    url_list = None
+else:
+    array, subsite, node, inst, delivery_methods = scripts.interactive_inputs.return_interactive_inputs()
 
-begin = input('Please enter a start date for your data requests with format <2014-01-01T00:00:00> or press enter to request all available data: ') or ''
-end = input('Please enter an end date for your data requests with format <2014-01-01T00:00:00> or press enter to request all available data: ') or ''
+    begin = input('Please enter a start date for your data requests with format <2014-01-01T00:00:00> or press enter to request all available data: ') or ''
+    end = input('Please enter an end date for your data requests with format <2014-01-01T00:00:00> or press enter to request all available data: ') or ''
 
-url_list = scripts.data_request_urls.main(sDir, array, subsite, node, inst, delivery_methods, begin, end, now)
-thredds_output_urls = scripts.send_data_requests_nc.main(sDir, url_list, username, token, now)
+    url_list = scripts.data_request_urls.main(sDir, array, subsite, node, inst, delivery_methods, begin, end, now,
+                                             chunk_days=chunk_days)
+thredds_output_urls = scripts.send_data_requests_nc.main(sDir, url_list, username, token, now, resume=resume)
 
 print('Seeing if the requests have fulfilled...')
-for i in range(len(thredds_output_urls)):
-    url = thredds_output_urls[i]
-    print('\nDataset {} of {}: {}'.format((i + 1), len(thredds_output_urls), url))
-    cf.check_request_status(url)
+with journal.RequestJournal(journal.journal_path(sDir, now)) as rj:
+    cf.wait_for_requests(thredds_output_urls, rj)
+
+metrics.write_run(sDir, now)
@@ -14,58 +14,48 @@ reference_designator (entries in all columns are optional). If this file is not
 the user for inputs
 username: OOI API username
 token: OOI API password
+chunk_days: optional, split each data request into equal time windows of at most this many days (e.g. 90) so the
+pieces fulfill in parallel. Streamed data get windows a tenth as long (e.g. 9 days for 90)
+resume: if True, skip the prompts and pick up the most recent run in sDir from its request journal without re-sending
+requests that were already sent
+profile: if True, run each stage under cProfile. Timing and throughput metrics of every run are saved in sDir as
+metrics_<now>.json and metrics_<now>.prom, and the profiles as profile_<now>_<stage>.prof
 """
 
 
 import datetime as dt
-import pandas as pd
 import os
-import itertools
 import functions.common as cf
+from functions import journal
+from functions import metrics
 import scripts
 
 sDir = '/Users/lgarzio/Documents/OOI'
 f = ''  # optional i.e. 'data_download.csv'
 username = 'username'
 token = 'token'
+chunk_days = None
+resume = False
+profile = False
 
 cf.create_dir(sDir)
+metrics.enable_profiling(profile)
 now = dt.datetime.now().strftime('%Y%m%dT%H%M')
 
-if not f:
+if resume:
+    now = journal.latest_run(sDir)
+    f_url_list = None
+elif not f:
     array, subsite, node, inst, delivery_methods = scripts.interactive_inputs.return_interactive_inputs()
-    f_url_list = scripts.data_request_urls_ooi1_0.main(sDir, array, subsite, node, inst, delivery_methods, now)
+    f_url_list = scripts.data_request_urls_ooi1_0.main(sDir, array, subsite, node, inst, delivery_methods, now, chunk_days)
 else:
-    df = pd.read_csv(os.path.join(sDir, f))
-    url_list = []
-    for i, j in df.iterrows():
-        array = scripts.data_request_tools.check_str(j['array'])
-        array = scripts.data_request_tools.format_inputs(array)
-        refdes = j['reference_designator']
-        if type(refdes) == str:
-            subsite = scripts.data_request_tools.format_inputs(refdes.split('-')[0])
-            node = scripts.data_request_tools.format_inputs(refdes.split('-')[1])
-            inst = scripts.data_request_tools.format_inputs('-'.join((refdes.split('-')[2], refdes.split('-')[3])))
-        else:
-            subsite = scripts.data_request_tools.check_str(j['subsite'])
-            subsite = scripts.data_request_tools.format_inputs(subsite)
-            node = scripts.data_request_tools.check_str(j['node'])
-            node = scripts.data_request_tools.format_inputs(node)
-            inst = scripts.data_request_tools.check_str(j['sensor'])
-            inst = scripts.data_request_tools.format_inputs(inst)
-        delivery_methods = scripts.data_request_tools.check_str(j['delivery_method'])
-        delivery_methods = scripts.data_request_tools.format_inputs(delivery_methods)
+    selections = scripts.data_request_urls_ooi1_0.read_selections(os.path.join(sDir, f))
+    f_url_list = scripts.data_request_urls_ooi1_0.plan_batch(sDir, selections, now, chunk_days)
 
-        urls = scripts.data_request_urls_ooi1_0.main(sDir, array, subsite, node, inst, delivery_methods, now)
-        url_list.append(urls)
-
-    f_url_list = list(itertools.chain(*url_list))
-
-thredds_output_urls = scripts.send_data_requests_nc.main(sDir, f_url_list, username, token, now)
+thredds_output_urls = scripts.send_data_requests_nc.main(sDir, f_url_list, username, token, now, resume=resume)
 
 print('\nSeeing if the requests have fulfilled...')
-for i in range(len(thredds_output_urls)):
-    url = thredds_output_urls[i]
-    print('\nDataset {} of {}: {}'.format((i + 1), len(thredds_output_urls), url))
-    if 'no_output_url' not in url:
-        cf.check_request_status(url)
+with journal.RequestJournal(journal.journal_path(sDir, now)) as rj:
+    cf.wait_for_requests(thredds_output_urls, rj)
+
+metrics.write_run(sDir, now)
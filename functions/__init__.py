@@ -1 +1,14 @@
-from . import common
\ No newline at end of file
+# submodules are imported on first use (PEP 562), see scripts/__init__.py
+import importlib
+
+__all__ = ['common', 'journal', 'metrics', 'rate_control']
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,20 +1,132 @@
 #! /usr/bin/env python
+import importlib.util
 import os
+import heapq
+import itertools
+import pandas as pd
+import random
 import requests
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functions import metrics
+from functions import rate_control
 
+# base urls of the OOI M2M and THREDDS servers, can be pointed at another server (e.g. the stand-in server used by the
+# benchmarks) with the OOI_M2M_URL and OOI_OPENDAP_URL environment variables
+M2M_URL = os.environ.get('OOI_M2M_URL', 'https://ooinet.oceanobservatories.org').rstrip('/')
+OPENDAP_URL = os.environ.get('OOI_OPENDAP_URL', 'https://opendap.oceanobservatories.org').rstrip('/')
+
+
+class RequestPoller(object):
+    """
+    Watches the status.txt files of many data requests at once. Each request is checked on its own exponential
+    backoff schedule (with jitter) until it fulfills or its timeout (in seconds) runs out. All of the checks go through
+    the rate controller rate (a new one by default, see functions/rate_control.py), which slows them down while the
+    server is throttling or slow to answer and pauses them for any Retry-After it gives. Iterating over the poller
+    yields (thredds_url, fulfilled) as each request finishes. Urls can be added while iterating, until close() is
+    called.
+    """
+
+    def __init__(self, session=None, n_workers=10, initial_wait=30, max_wait=600, timeout=48 * 3600, rate=None):
+        if session is None:
+            session = get_session(pool_size=n_workers)
+        self.session = session
+        self.n_workers = n_workers
+        self.initial_wait = initial_wait
+        self.max_wait = max_wait
+        self.timeout = timeout
+        if rate is None:
+            rate = rate_control.RateController(rate=5.0, max_rate=50.0, burst=n_workers, name='status_check')
+        self.rate = rate
+        self._cond = threading.Condition()
+        self._due = []  # heap of (time of next check, sequence, thredds_url)
+        self._state = dict()  # thredds_url: [time added, number of checks]
+        self._seq = itertools.count()
+        self._closed = False
+
+    def add(self, thredds_url):
+        with self._cond:
+            if thredds_url not in self._state:
+                self._state[thredds_url] = [time.time(), 0]
+                heapq.heappush(self._due, (time.time(), next(self._seq), thredds_url))
+                self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _check(self, thredds_url):
+        self.rate.acquire()
+        stime = time.time()
+        try:
+            r = self.session.get(status_url(thredds_url))
+            metrics.count('status_checks')
+        except requests.exceptions.RequestException:
+            self.rate.record(None, time.time() - stime)
+            return False  # try again on the next check
+        # status.txt is missing (404) until the request fulfills, which is not a sign of a busy server
+        self.rate.record(r.status_code, time.time() - stime, rate_control.retry_after(r))
+        return r.status_code == requests.codes.ok
+
+    def _backoff(self, checks):
+        wait_time = min(self.max_wait, self.initial_wait * 2 ** checks)
+        return random.uniform(wait_time / 2, wait_time)
+
+    def __iter__(self):
+        pending = dict()
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            while True:
+                with self._cond:
+                    while self._due and self._due[0][0] <= time.time() and len(pending) < self.n_workers:
+                        thredds_url = heapq.heappop(self._due)[2]
+                        pending[executor.submit(self._check, thredds_url)] = thredds_url
+                    next_due = self._due[0][0] - time.time() if self._due else None
+                    if not pending:
+                        if self._closed and not self._due:
+                            return
+                        self._cond.wait(next_due)
+                        continue
+                    closed = self._closed
+
+                if len(pending) >= self.n_workers:
+                    timeout = None  # nothing more can start until a check finishes, even if one is overdue
+                else:
+                    # wake up when the next check is due, and at least once a second while urls can still be added
+                    timeout = None if next_due is None else max(0, next_due)
+                    if not closed:
+                        timeout = 1 if timeout is None else min(timeout, 1)
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for fut in done:
+                    thredds_url = pending.pop(fut)
+                    fulfilled = fut.result()
+                    with self._cond:
+                        added, checks = self._state[thredds_url]
+                        if fulfilled or time.time() - added > self.timeout:
+                            del self._state[thredds_url]
+                            if fulfilled:
+                                metrics.observe('fulfillment_wait', time.time() - added)
+                            metrics.count('requests_fulfilled' if fulfilled else 'requests_timed_out')
+                        else:
+                            self._state[thredds_url][1] = checks + 1
+                            heapq.heappush(self._due, (time.time() + self._backoff(checks), next(self._seq), thredds_url))
+                            continue
+                    yield thredds_url, fulfilled
+
+
+def cache_dir():
+    # local cache for catalogs and databases, can be moved by setting OOI_DATA_CACHE
+    cdir = os.environ.get('OOI_DATA_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'ooi-data-download'))
+    create_dir(cdir)
+    return cdir
 
-def check_request_status(thredds_url):
-    check_complete = thredds_url.replace('/catalog/', '/fileServer/')
-    check_complete = check_complete.replace('/catalog.html', '/status.txt')
-    session = requests.session()
-    r = session.get(check_complete)
-    while r.status_code != requests.codes.ok:
-        print('Data request is still fulfilling. Trying again in 1 minute.')
-        time.sleep(60)
-        r = session.get(check_complete)
-    print('Data request has fulfilled.')
+
+def check_request_status(thredds_url, timeout=48 * 3600):
+    # wait for one data request to fulfill (or time out), use wait_for_requests or RequestPoller to get the result
+    wait_for_requests([thredds_url], timeout=timeout)
 
 
 def create_dir(new_dir):
@@ -27,3 +139,72 @@ def create_dir(new_dir):
                 pass
             else:
                 raise
+
+
+def get_session(pool_size=10):
+    # one session shared across threads, keeping up to pool_size connections per host alive
+    session = requests.session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def read_frame(fpath):
+    # read a DataFrame saved with write_frame, fpath is given without the file extension
+    if os.path.isfile(fpath + '.parquet'):
+        try:
+            return pd.read_parquet(fpath + '.parquet')
+        except ImportError:  # pyarrow is no longer installed
+            pass
+    if os.path.isfile(fpath + '.pkl'):
+        return pd.read_pickle(fpath + '.pkl')
+    return None
+
+
+def status_url(thredds_url):
+    check_complete = thredds_url.replace('/catalog/', '/fileServer/')
+    check_complete = check_complete.replace('/catalog.html', '/status.txt')
+    return check_complete
+
+
+def wait_for_requests(thredds_urls, rj=None, **kwargs):
+    """
+    Poll all of the data requests at once and report each one as it finishes. Returns a dictionary of
+    thredds_url: True if the request fulfilled, False if it timed out. Fulfilled requests are recorded in the request
+    journal rj (optional, see functions/journal.py). Keyword arguments are passed to RequestPoller.
+    """
+    thredds_urls = [t for t in thredds_urls if 'no_output_url' not in t]
+    poller = RequestPoller(**kwargs)
+    for t in thredds_urls:
+        poller.add(t)
+    poller.close()
+
+    results = dict()
+    for t, fulfilled in poller:
+        results[t] = fulfilled
+        if fulfilled:
+            if rj:
+                rj.record_output(t, 'fulfilled')
+            print('\nData request has fulfilled ({} of {} complete): {}'.format(len(results), len(thredds_urls), t))
+        else:
+            print('\nData request timed out before fulfilling ({} of {} complete): {}'.format(len(results), len(thredds_urls), t))
+    return results
+
+
+def write_frame(df, fpath):
+    """
+    Save a DataFrame to a fast-loading file. Uses parquet (columnar) when pyarrow is installed and falls back to
+    pickle otherwise. fpath is given without the file extension, the full path of the file is returned.
+    """
+    ext = '.parquet' if importlib.util.find_spec('pyarrow') else '.pkl'
+    tmp = fpath + ext + '.tmp'
+    if ext == '.parquet':
+        df.to_parquet(tmp, index=False)
+    else:
+        df.to_pickle(tmp)
+    os.replace(tmp, fpath + ext)
+    for stale in ({'.parquet', '.pkl'} - {ext}):
+        if os.path.isfile(fpath + stale):
+            os.remove(fpath + stale)
+    return fpath + ext
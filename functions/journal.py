@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+"""
+Append-only journal of the data requests in a run. Each request moves through the states planned, submitted,
+fulfilled and downloaded, and every change is appended to sDir/request_journal_<now>.jsonl as one json line, so an
+interrupted run can be resumed from the journal without re-sending the requests that were already sent.
+"""
+
+import glob
+import json
+import os
+import threading
+import time
+
+STATES = ['planned', 'submitted', 'fulfilled', 'downloaded']
+
+
+class RequestJournal(object):
+    """
+    Records are written to the journal file right away and fsync'd in batches (every sync_every records or
+    sync_interval seconds, and on close), so a crash can only lose the last batch still held by the operating system.
+    Opening an existing journal replays it: requests holds the latest state and outputUrl of every request url, in
+    the order the requests were planned. Safe to share between threads.
+    """
+
+    def __init__(self, fpath, sync_every=50, sync_interval=5):
+        self.fpath = fpath
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.requests = dict()
+        self.request_urls = dict()  # outputUrl: request url
+        self._lock = threading.Lock()
+
+        torn = False
+        if os.path.isfile(fpath):
+            with open(fpath) as f:
+                for line in f:
+                    torn = not line.endswith('\n')
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:  # last line cut short by a crash
+                        continue
+                    self._apply(rec['url'], rec['state'], rec.get('outputUrl'))
+        self._f = open(fpath, 'a')
+        if torn:
+            self._f.write('\n')  # start a new line after a record cut short by a crash
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _apply(self, url, state, outputUrl):
+        entry = self.requests.setdefault(url, dict(state=state, outputUrl=None))
+        entry['state'] = state
+        if outputUrl:
+            entry['outputUrl'] = outputUrl
+            self.request_urls[outputUrl] = url
+
+    def close(self):
+        with self._lock:
+            if not self._f.closed:
+                self._sync()
+                self._f.close()
+
+    def output_urls(self, states):
+        # outputUrls of the requests currently in one of states, in the order the requests were planned
+        with self._lock:
+            return [e['outputUrl'] for e in self.requests.values() if e['state'] in states and e['outputUrl']]
+
+    def record(self, url, state, outputUrl=None):
+        if state not in STATES:
+            raise Exception('Unknown request state: {}'.format(state))
+        rec = dict(url=url, state=state, time=time.time())
+        if outputUrl:
+            rec['outputUrl'] = outputUrl
+        with self._lock:
+            self._apply(url, state, outputUrl)
+            self._f.write(json.dumps(rec) + '\n')
+            self._f.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every or time.time() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def record_output(self, outputUrl, state):
+        # record a new state for the request that returned outputUrl, if it is in the journal
+        url = self.request_urls.get(outputUrl)
+        if url is not None:
+            self.record(url, state, outputUrl)
+
+    def _sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def urls(self, state):
+        # request urls currently in state, in the order they were planned
+        with self._lock:
+            return [u for u, e in self.requests.items() if e['state'] == state]
+
+
+def journal_path(sDir, now):
+    return os.path.join(sDir, 'request_journal_{}.jsonl'.format(now))
+
+
+def has_records(fpath):
+    # True if the journal at fpath holds at least one complete record
+    with open(fpath) as f:
+        for line in f:
+            try:
+                json.loads(line)
+            except ValueError:
+                continue
+            return True
+    return False
+
+
+def latest_run(sDir):
+    # the timestamp (now) of the most recent run with a journal in sDir, skipping journals without any records
+    journals = [f for f in sorted(glob.glob(journal_path(sDir, '*'))) if has_records(f)]
+    if not journals:
+        raise Exception('No request journal found in {}, nothing to resume'.format(sDir))
+    return os.path.basename(journals[-1])[len('request_journal_'):-len('.jsonl')]
@@ -0,0 +1,165 @@
+#! /usr/bin/env python
+"""
+Timing and throughput metrics for the stages of a run (catalog fetch and parse, database load, filtering, url
+building, request submission, fulfillment wait and downloads). Stages are timed with the stage() context manager or
+observe(), and totals are kept with count(). write_run() saves everything measured in the process as
+sDir/metrics_<now>.json and a Prometheus textfile, sDir/metrics_<now>.prom (e.g. for the node_exporter textfile
+collector). After enable_profiling(), each stage also runs under cProfile and its statistics are saved by write_run()
+as sDir/profile_<now>_<stage>.prof (open with pstats or snakeviz).
+
+The catalog is parsed while it streams in, so catalog_parse includes the time spent waiting for catalog_fetch.
+"""
+
+import cProfile
+import functools
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_local = threading.local()
+_started = time.time()
+_timers = dict()  # stage: [number of calls, total seconds, max seconds]
+_counters = dict()
+_profiles = dict()  # stage: [cProfile.Profile]
+_profiling = [False]
+
+
+def count(name, n=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def enable_profiling(enabled=True):
+    _profiling[0] = enabled
+
+
+def observe(name, seconds):
+    with _lock:
+        timer = _timers.setdefault(name, [0, 0.0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+
+
+def reset():
+    global _started
+    with _lock:
+        _started = time.time()
+        _timers.clear()
+        _counters.clear()
+        _profiles.clear()
+
+
+def snapshot():
+    """
+    Return the metrics measured so far as a dictionary. Derived rates are added for downloads (bytes per second of
+    download time) and submissions (requests per second of wall time).
+    """
+    with _lock:
+        wall_time = time.time() - _started
+        stages = dict((k, dict(count=c, total_seconds=t, max_seconds=m, mean_seconds=t / c))
+                      for k, (c, t, m) in _timers.items())
+        counters = dict(_counters)
+    rates = dict()
+    if counters.get('download_bytes') and stages.get('download_file'):
+        rates['download_bytes_per_second'] = counters['download_bytes'] / max(stages['download_file']['total_seconds'],
+                                                                              1e-6)
+    if counters.get('requests_submitted'):
+        rates['requests_submitted_per_second'] = counters['requests_submitted'] / max(wall_time, 1e-6)
+    return dict(started=_started, wall_time=wall_time, stages=stages, counters=counters, rates=rates)
+
+
+@contextmanager
+def stage(name):
+    """
+    Time the code run in the with block as one call of stage name, and profile it when profiling is enabled. A stage
+    nested in another profiled stage of the same thread is timed but not profiled separately.
+    """
+    profiler = None
+    if _profiling[0] and not getattr(_local, 'profiling', False):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            _local.profiling = True
+        except ValueError:  # another thread is already profiling (python 3.12+ allows one profiler at a time)
+            profiler = None
+    stime = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - stime)
+        if profiler:
+            profiler.disable()
+            _local.profiling = False
+            with _lock:
+                _profiles.setdefault(name, []).append(profiler)
+
+
+def timed(name):
+    # decorator that runs each call of the function as a call of stage name
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(iterable, name):
+    # yield from iterable, timing each wait for the next item as a call of stage name (e.g. network reads of a stream)
+    it = iter(iterable)
+    while True:
+        stime = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        finally:
+            observe(name, time.perf_counter() - stime)
+        yield item
+
+
+def write_run(sDir, now):
+    """
+    Save the metrics of the run as sDir/metrics_<now>.json and sDir/metrics_<now>.prom, and the cProfile statistics of
+    each profiled stage as sDir/profile_<now>_<stage>.prof. Returns the metrics (see snapshot).
+    """
+    metrics = snapshot()
+    metrics['run'] = now
+    fpath = os.path.join(sDir, 'metrics_{}'.format(now))
+    with open(fpath + '.json.tmp', 'w') as f:
+        json.dump(metrics, f, indent=1, sort_keys=True)
+    os.replace(fpath + '.json.tmp', fpath + '.json')
+
+    lines = ['# TYPE ooi_run_wall_seconds gauge', 'ooi_run_wall_seconds{{run="{}"}} {}'.format(now, metrics['wall_time'])]
+    for metric, key, mtype in (('ooi_stage_calls_total', 'count', 'counter'),
+                               ('ooi_stage_seconds_total', 'total_seconds', 'counter'),
+                               ('ooi_stage_seconds_max', 'max_seconds', 'gauge')):
+        lines.append('# TYPE {} {}'.format(metric, mtype))
+        for name in sorted(metrics['stages']):
+            lines.append('{}{{run="{}",stage="{}"}} {}'.format(metric, now, name, metrics['stages'][name][key]))
+    for name in sorted(metrics['counters']):
+        lines.append('# TYPE ooi_{}_total counter'.format(name))
+        lines.append('ooi_{}_total{{run="{}"}} {}'.format(name, now, metrics['counters'][name]))
+    for name in sorted(metrics['rates']):
+        lines.append('# TYPE ooi_{} gauge'.format(name))
+        lines.append('ooi_{}{{run="{}"}} {}'.format(name, now, metrics['rates'][name]))
+    with open(fpath + '.prom.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(fpath + '.prom.tmp', fpath + '.prom')
+
+    with _lock:
+        profiles = dict(_profiles)
+    for name, profilers in profiles.items():
+        pstats.Stats(*profilers).dump_stats(os.path.join(sDir, 'profile_{}_{}.prof'.format(now, name)))
+
+    print('\nRun metrics saved to {}.json'.format(fpath))
+    for name in sorted(metrics['stages'], key=lambda k: -metrics['stages'][k]['total_seconds']):
+        s = metrics['stages'][name]
+        print('{}: {} calls, {:.2f} seconds'.format(name, s['count'], s['total_seconds']))
+    return metrics
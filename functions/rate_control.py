@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+"""
+Client-side rate control for requests to the OOI servers (data request submissions to uFrame and status checks on
+THREDDS). A RateController is a token bucket whose rate is adjusted with AIMD (additive increase, multiplicative
+decrease): every quick, successful response raises the rate a little, and a throttled response (400 from a busy
+uFrame, 429 or 5xx), a connection error or a slow response cuts it in half. A Retry-After header pauses every request
+through the controller until the time given. Requests that keep failing are re-sent with exponential backoff until
+they run out of attempts or time (see RetryPolicy).
+"""
+
+import email.utils
+import random
+import threading
+import time
+from functions import metrics
+
+THROTTLE_CODES = [400, 429, 500, 502, 503, 504]  # uFrame answers 400 when it is too busy to take a data request
+
+
+class RateController(object):
+    """
+    Token bucket shared by the threads sending requests to one server. acquire() blocks until a request may be sent,
+    and record() adjusts the rate (requests per second, between min_rate and max_rate) from the response. Up to burst
+    requests can be sent at once after a quiet period. A response slower than slow_latency seconds counts as a sign of
+    an overloaded server, as does a throttled response. Only requests sent after the last cut can cut the rate again, so
+    a burst of failures from requests that were already in flight only cuts it once.
+    """
+
+    def __init__(self, rate=2.0, min_rate=0.05, max_rate=20.0, burst=5, increase=0.2, decrease=0.5, slow_latency=30,
+                 name='requests'):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_latency = slow_latency
+        self.name = name
+        self._cond = threading.Condition()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+
+    def acquire(self):
+        # wait for a token, returns the seconds spent waiting
+        stime = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                wait_time = self._paused_until - now
+                if wait_time <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        break
+                    wait_time = (1 - self._tokens) / self.rate
+                self._cond.wait(wait_time)
+        waited = time.monotonic() - stime
+        if waited > 0.001:
+            metrics.observe('{}_rate_wait'.format(self.name), waited)
+        return waited
+
+    def record(self, status_code=None, latency=0.0, retry_after=None):
+        """
+        Adjust the rate from one response: status_code is None for a request that got no response (connection
+        error or timeout), latency is the seconds the request took and retry_after the seconds from its Retry-After
+        header (if any). Returns True if the response was throttled.
+        """
+        throttled = status_code is None or status_code in THROTTLE_CODES
+        with self._cond:
+            now = time.monotonic()
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            if throttled or latency > self.slow_latency:
+                if now - latency >= self._last_decrease:
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self._last_decrease = now
+                    self._tokens = min(self._tokens, 1.0)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+            self._cond.notify_all()
+        if throttled:
+            metrics.count('{}_throttled'.format(self.name))
+        return throttled
+
+
+class RetryPolicy(object):
+    """
+    When and whether to re-send a failed request: the wait starts at initial_wait seconds and doubles (with jitter)
+    up to max_wait, unless the server gave a Retry-After. A request is given up after max_attempts attempts or
+    max_elapsed seconds since its first attempt (None for no limit).
+    """
+
+    def __init__(self, initial_wait=2, max_wait=60, max_attempts=10, max_elapsed=3600):
+        self.initial_wait = initial_wait
+        self.max_wait = max_wait
+        self.max_attempts = max_attempts
+        self.max_elapsed = max_elapsed
+
+    def give_up(self, attempts, started):
+        if self.max_attempts and attempts >= self.max_attempts:
+            return True
+        return bool(self.max_elapsed) and time.time() - started > self.max_elapsed
+
+    def wait(self, attempts, retry_after=None):
+        # seconds to wait before the next attempt of a request that failed attempts times
+        if retry_after:
+            return retry_after
+        wait_time = min(self.max_wait, self.initial_wait * 2 ** (attempts - 1))
+        return random.uniform(wait_time / 2, wait_time)
+
+
+def retry_after(r):
+    # seconds in the Retry-After header of response r (given as seconds or as an HTTP date), or None
+    if r is None:
+        return None
+    value = r.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -1,8 +1,17 @@
-from . import data_request_tools
-from . import data_request_urls
-from . import data_request_urls_nocheck
-from . import data_request_urls_ooi1_0
-from . import interactive_inputs
-from . import m2m_get_annotations
-from . import send_data_requests_nc
-from . import thredds_download_nc
\ No newline at end of file
+# submodules are imported on first use (PEP 562), so importing the package (e.g. for the command line interface in
+# cli.py) does not load pandas, requests and the xml parsers before they are needed
+import importlib
+
+__all__ = ['annotation_index', 'cli', 'consolidate_zarr', 'data_request_tools', 'dataset_index', 'data_request_urls',
+           'data_request_urls_nocheck', 'data_request_urls_ooi1_0', 'interactive_inputs', 'm2m_get_annotations',
+           'opendap_subset_nc', 'pipeline_nc', 'send_data_requests_nc', 'sensor_inventory', 'thredds_download_nc']
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
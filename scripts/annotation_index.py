@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+@brief: Interval index of the annotations saved by m2m_get_annotations.py, for finding the annotations (by default
+only the exclusion annotations) that overlap a time range of a reference designator, stream and parameter, e.g. to
+check the deployments of many downloaded datasets. Annotations are grouped by subsite, node, sensor and stream, with
+the time ranges of each group sorted, so a query is a few dictionary lookups and binary searches. An annotation
+applies to everything below the level it was made at: one without a node applies to the whole subsite, one without
+a stream to every stream of the instrument, one without a method to every delivery method and one without
+parameters to every parameter.
+
+@usage:
+fpath: annotation file saved by m2m_get_annotations.py (the csv name or the columnar file, e.g.
+    saveDir/uframe_annotations_all.csv)
+refdes: fully- or partially-qualified reference designator (e.g. GI01SUMO-SBD11-06-METBKA000)
+begin, end: time range (e.g. 2016-01-01T00:00:00, or a datetime)
+stream, method, parameter: optional, e.g. 'metbk_a_dcl_instrument', 'telemetered', 911 (the parameter ID)
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import functions.common as cf
+
+OPEN_END = np.iinfo(np.int64).max  # end of annotations without an end date
+
+
+class AnnotationIndex(object):
+    """
+    Built from the DataFrame of annotations returned by m2m_get_annotations.annotation_frame (or loaded with load()).
+    overlaps() returns the positions of matching annotations in df, query() the matching rows.
+    """
+
+    def __init__(self, df, exclusion_only=True):
+        if exclusion_only:
+            df = df[df['exclusionFlag']]
+        self.df = df.reset_index(drop=True)
+        begins = self.df['beginDT'].fillna(0).to_numpy(dtype=np.int64)
+        ends = self.df['endDT'].fillna(OPEN_END).to_numpy(dtype=np.int64)
+        self._methods = [v if isinstance(v, str) and v else None for v in self.df['method']]
+        self._parameters = [set(p) for p in self.df['parameters']]
+
+        # group key: (subsite, node, sensor, stream), None for the levels the annotation applies to all of
+        columns = [[v if isinstance(v, str) and v else None for v in self.df[c]]
+                   for c in ('subsite', 'node', 'sensor', 'stream')]
+        positions = dict()
+        for i, key in enumerate(zip(*columns)):
+            positions.setdefault(key, []).append(i)
+        self._groups = dict()
+        self._children = dict()  # (subsite,), (subsite, node) and (subsite, node, sensor): keys of the groups below
+        for key, rows in positions.items():
+            rows = np.array(rows, dtype=np.int64)
+            rows = rows[np.argsort(begins[rows], kind='stable')]
+            # with the running maximum of the ends, the annotations that end before a query begins are skipped by a
+            # binary search
+            self._groups[key] = (begins[rows], ends[rows], np.maximum.accumulate(ends[rows]), rows)
+            for depth in range(1, 4):
+                self._children.setdefault(key[:depth], []).append(key)
+
+    def overlaps(self, refdes, begin=None, end=None, stream=None, method=None, parameter=None):
+        """
+        Positions (in df) of the annotations that apply to refdes (and stream, method and parameter, if given) and
+        overlap begin to end (open-ended if not given), sorted by position. A partially-qualified refdes also matches
+        every annotation below it.
+        """
+        begin = to_ms(begin, 0)
+        end = to_ms(end, OPEN_END)
+        parts = refdes.split('-')
+        levels = [parts[0], '-'.join(parts[1:2]), '-'.join(parts[2:4])]
+
+        # the annotations made at each level above the one given, and every annotation at and below it
+        keys = []
+        for depth in range(1, 4):
+            if not levels[depth - 1]:
+                keys.extend(self._children.get(tuple(levels[:depth - 1]), []))
+                break
+            if depth < 3:
+                keys.append(tuple(levels[:depth]) + (None,) * (4 - depth))
+            elif stream:
+                keys.extend([tuple(levels) + (None,), tuple(levels) + (stream,)])
+            else:
+                keys.extend(self._children.get(tuple(levels), []))
+
+        found = []
+        for key in keys:
+            group = self._groups.get(key)
+            if group is None:
+                continue
+            begins, ends, max_ends, rows = group
+            i0 = np.searchsorted(max_ends, begin, side='left')
+            i1 = np.searchsorted(begins, end, side='right')
+            if i0 < i1:
+                found.append(rows[i0:i1][ends[i0:i1] >= begin])
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        rows = np.unique(np.concatenate(found))
+
+        if method or parameter is not None:
+            parameter = None if parameter is None else int(str(parameter).replace('PD', ''))
+            rows = np.array([r for r in rows if (not method or not self._methods[r] or self._methods[r] == method)
+                             and (parameter is None or not self._parameters[r] or parameter in self._parameters[r])],
+                            dtype=np.int64)
+        return rows
+
+    def query(self, refdes, begin=None, end=None, stream=None, method=None, parameter=None):
+        # the annotations matching overlaps() as a DataFrame, sorted by beginDT
+        rows = self.overlaps(refdes, begin, end, stream, method, parameter)
+        return self.df.iloc[rows].sort_values('beginDT')
+
+
+def load(fpath, exclusion_only=True):
+    # index of the annotations saved by m2m_get_annotations.py, fpath can be given with or without the extension
+    df = cf.read_frame(os.path.splitext(fpath)[0])
+    if df is None:
+        raise Exception('No annotation file found: {}'.format(fpath))
+    return AnnotationIndex(df, exclusion_only)
+
+
+def to_ms(t, default):
+    # milliseconds since 1970 of a date string, datetime or number (milliseconds, or nanoseconds if it is too large
+    # to be milliseconds, e.g. the value of a datetime64)
+    if t is None or (isinstance(t, str) and not t):
+        return default
+    if isinstance(t, (int, float, np.integer, np.floating)):
+        return int(t // 1000000) if abs(t) >= 1e15 else int(t)
+    return pd.Timestamp(t).value // 1000000
+
+
+if __name__ == '__main__':
+    fpath = '/Users/lgarzio/Documents/OOI/Annotations/uframe_annotations_all.csv'
+    refdes = 'GI01SUMO-SBD11-06-METBKA000'
+    begin = '2016-01-01T00:00:00'
+    end = '2016-06-01T00:00:00'
+    index = load(fpath)
+    print(index.query(refdes, begin, end))
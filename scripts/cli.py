@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""
+@brief: Non-interactive command line interface to the download tools, for scheduled and batch jobs. Each subcommand
+imports only the tools it needs, so status and help answer right away.
+    plan: build the data request urls for the science streams of the instruments selected, from the GUI data catalog
+        (--source catalog, data_request_urls_nocheck.py), checked against the Datateam Database (--source qcdb,
+        data_request_urls.py) or for the OOI 1.0 deployments in the data review list (--source review-list, optionally
+        for every row of a --csv file like data_download.csv, data_request_urls_ooi1_0.py)
+    submit: send the data requests of a run (send_data_requests_nc.py), or with --pipeline send, wait for and download
+        them as one pipeline (pipeline_nc.py)
+    wait: wait for the submitted data requests of a run to fulfill
+    download: download the files of the data requests of a run that have not been downloaded yet
+    annotations: download the annotations of reference designators to sDir/annotations (m2m_get_annotations.py)
+    status: print the number of data requests of a run in each state of its request journal
+
+@usage (from the top directory of the repository, or with the ooi-data-download command after pip install):
+python -m scripts.cli --config ooi.ini plan --subsite GI01SUMO --inst CTD --begin 2016-01-01T00:00:00
+python -m scripts.cli --config ooi.ini plan --source review-list --csv data_download.csv
+python -m scripts.cli --config ooi.ini submit --pipeline
+python -m scripts.cli status --sdir /data/ooi
+Runs are identified by their timestamp (now). plan starts a new run, submit picks up the most recently planned run,
+and the other subcommands the most recently submitted run, unless --run is given. Any option can also be set in an
+INI config file: options for every subcommand in an [ooi] section and options for one subcommand in a section named
+after it (e.g. [plan]), with dashes in option names written as underscores, e.g.
+[ooi]
+sdir = /data/ooi
+username = OOIAPI-XXXXXXXXXXXXXX
+token = XXXXXXXXXXXX
+[submit]
+pipeline = true
+Options given on the command line take precedence over the config file.
+"""
+
+import argparse
+import configparser
+import datetime as dt
+import glob
+import os
+import sys
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='ooi-data-download',
+                                     description='Download data from uFrame via the OOI M2M interface.')
+    parser.add_argument('--config', help='INI file with default options')
+    sub = parser.add_subparsers(dest='command', metavar='command')
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--sdir', help='directory where outputs are saved')
+    common.add_argument('--run', help='timestamp (now) of the run, e.g. 20181012T1200')
+    common.add_argument('--profile', action='store_true', help='run each stage under cProfile')
+    creds = argparse.ArgumentParser(add_help=False)
+    creds.add_argument('--username', help='OOI API username')
+    creds.add_argument('--token', help='OOI API password')
+
+    p = sub.add_parser('plan', parents=[common], help='build the data request urls of a new run')
+    for opt in ('array', 'subsite', 'node', 'inst'):
+        p.add_argument('--' + opt, default='', help='comma-separated {}s (default: all)'.format(opt))
+    p.add_argument('--methods', default='', help='comma-separated delivery methods: streamed, telemetered, recovered')
+    p.add_argument('--begin', default='', help='start date, e.g. 2014-01-01T00:00:00')
+    p.add_argument('--end', default='', help='end date, e.g. 2015-01-01T00:00:00')
+    p.add_argument('--chunk-days', type=int, help='split each data request into equal time windows of at most this '
+                                                   'many days (a tenth of that for streamed data, e.g. 9 for 90)')
+    p.add_argument('--refresh-catalog', action='store_true', help='download the GUI data catalog again')
+    p.add_argument('--source', choices=['catalog', 'qcdb', 'review-list'], default='catalog',
+                   help='catalog: science streams in the GUI data catalog (default), qcdb: only those also in the '
+                        'Datateam Database, review-list: OOI 1.0 deployments in the data review list')
+    p.add_argument('--csv', help='with --source review-list, csv file of selections to plan in one batch (columns: '
+                                 'array, subsite, node, sensor, delivery_method, reference_designator)')
+
+    p = sub.add_parser('submit', parents=[common, creds], help='send the data requests of a run')
+    p.add_argument('--pipeline', action='store_true', help='also wait for and download each request as it fulfills')
+    p.add_argument('--resume', action='store_true', help='pick the run up from its request journal')
+    p.add_argument('--n-workers', type=int, default=5, help='data requests in flight at once')
+    p.add_argument('--n-download', type=int, default=2, help='fulfilled requests downloaded at once (--pipeline)')
+    p.add_argument('--retry-wait', type=float, default=60, help='maximum seconds before a rejected request is re-sent')
+    p.add_argument('--poll-wait', type=float, default=30, help='initial seconds between status checks (--pipeline)')
+
+    p = sub.add_parser('wait', parents=[common], help='wait for the submitted data requests of a run to fulfill')
+    p.add_argument('--poll-wait', type=float, default=30, help='initial seconds between status checks')
+
+    p = sub.add_parser('download', parents=[common], help='download the fulfilled data requests of a run')
+    p.add_argument('--n-workers', type=int, default=4, help='files downloaded at once')
+
+    p = sub.add_parser('annotations', parents=[common, creds], help='download annotations')
+    p.add_argument('--refdes', default='', help='comma-separated reference designators (default: all)')
+
+    sub.add_parser('status', parents=[common], help='print the state of the data requests of a run')
+    return parser
+
+
+def apply_config(parser, fpath):
+    # use the [ooi] section and the section of each subcommand as the defaults of its options
+    config = configparser.ConfigParser()
+    if not config.read(fpath):
+        raise Exception('Config file not found: {}'.format(fpath))
+    subparsers = [a for a in parser._actions if isinstance(a, argparse._SubParsersAction)][0]
+    for command, p in subparsers.choices.items():
+        options = dict()
+        for section in ('ooi', command):
+            if config.has_section(section):
+                options.update((k.replace('-', '_'), v) for k, v in config.items(section))
+        for action in p._actions:
+            if action.dest in options and isinstance(action, argparse._StoreTrueAction):
+                options[action.dest] = configparser.ConfigParser.BOOLEAN_STATES[options[action.dest].lower()]
+        p.set_defaults(**options)
+
+
+def latest_file_run(sDir, prefix, ext='.csv'):
+    # timestamp (now) of the newest sDir/<prefix>_<now><ext>, or None if there is none
+    files = sorted(glob.glob(os.path.join(sDir, '{}_*{}'.format(prefix, ext))))
+    if not files:
+        return None
+    return os.path.basename(files[-1])[len(prefix) + 1:-len(ext)]
+
+
+def main(argv=None):
+    parser = build_parser()
+    args, _ = parser.parse_known_args(argv)
+    if args.config:
+        apply_config(parser, args.config)
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_help()
+        return 1
+    if not args.sdir:
+        parser.error('--sdir is required (on the command line or in the config file)')
+    if args.command == 'plan' and args.source == 'review-list' and (args.begin or args.end or args.refresh_catalog):
+        parser.error('--begin, --end and --refresh-catalog do not apply to --source review-list (the dates come '
+                     'from the review list)')
+    if args.command == 'plan' and args.csv and args.source != 'review-list':
+        parser.error('--csv only applies to --source review-list')
+    if args.command in ('submit', 'annotations') and not (args.username and args.token):
+        parser.error('--username and --token are required (on the command line or in the config file)')
+
+    if args.command == 'annotations':
+        run_annotations(args)
+        return 0
+
+    from functions import journal
+    from functions import metrics
+    metrics.enable_profiling(args.profile)
+    if args.command == 'plan':
+        now = args.run or dt.datetime.now().strftime('%Y%m%dT%H%M')
+    elif args.command == 'submit' and not args.resume:
+        now = args.run or latest_file_run(args.sdir, 'data_request_urls')
+        if not now:
+            print('error: no data request urls to submit in {}, run plan first'.format(args.sdir), file=sys.stderr)
+            return 1
+    else:
+        now = args.run or latest_file_run(args.sdir, 'request_journal', '.jsonl')
+        if not now or not os.path.isfile(journal.journal_path(args.sdir, now)):
+            print('error: no request journal for run {} in {}'.format(now or '(latest)', args.sdir), file=sys.stderr)
+            return 1
+
+    if args.command == 'status':
+        return status(args.sdir, now)
+    commands = dict(plan=run_plan, submit=run_submit, wait=run_wait, download=run_download)
+    commands[args.command](args, now)
+    metrics.write_run(args.sdir, now)
+    return 0
+
+
+def run_annotations(args):
+    from . import m2m_get_annotations
+    m2m_get_annotations.main(args.username, args.token, args.refdes, os.path.join(args.sdir, 'annotations'))
+
+
+def run_download(args, now):
+    from functions import journal
+    from . import thredds_download_nc
+    with journal.RequestJournal(journal.journal_path(args.sdir, now)) as rj:
+        thredds_urls = [t for t in rj.output_urls(['submitted', 'fulfilled']) if 'no_output_url' not in t]
+    print('Downloading {} data requests of run {}'.format(len(thredds_urls), now))
+    thredds_download_nc.main(args.sdir, thredds_urls, args.n_workers, now=now)
+
+
+def run_plan(args, now):
+    from . import data_request_tools
+    inputs = [data_request_tools.format_inputs(x) for x in (args.array, args.subsite, args.node, args.inst,
+                                                             args.methods)]
+    if args.source == 'review-list':
+        from . import data_request_urls_ooi1_0
+        if args.csv:
+            selections = data_request_urls_ooi1_0.read_selections(os.path.join(args.sdir, args.csv))
+        else:
+            selections = [tuple(inputs)]
+        url_list = data_request_urls_ooi1_0.plan_batch(args.sdir, selections, now, args.chunk_days)
+    elif args.source == 'qcdb':
+        from . import data_request_urls
+        url_list = data_request_urls.main(args.sdir, *inputs, begin=args.begin, end=args.end, now=now,
+                                          refresh_catalog=args.refresh_catalog, chunk_days=args.chunk_days)
+    else:
+        from . import data_request_urls_nocheck
+        url_list = data_request_urls_nocheck.main(args.sdir, *inputs, begin=args.begin, end=args.end, now=now,
+                                                  refresh_catalog=args.refresh_catalog, chunk_days=args.chunk_days)
+    print('Saved {} data request urls for run {} to {}'.format(
+        len(url_list), now, os.path.join(args.sdir, 'data_request_urls_{}.csv'.format(now))))
+
+
+def run_submit(args, now):
+    urls = 'data_request_urls_{}.csv'.format(now)
+    if args.pipeline:
+        from . import pipeline_nc
+        pipeline_nc.main(args.sdir, urls, args.username, args.token, now, args.n_workers, args.n_download,
+                         resume=args.resume, poll_wait=args.poll_wait, retry_wait=args.retry_wait, confirm=False)
+    else:
+        from . import send_data_requests_nc
+        send_data_requests_nc.main(args.sdir, urls, args.username, args.token, now, args.n_workers, args.resume,
+                                   args.retry_wait, confirm=False)
+
+
+def run_wait(args, now):
+    import functions.common as cf
+    from functions import journal
+    with journal.RequestJournal(journal.journal_path(args.sdir, now)) as rj:
+        thredds_urls = rj.output_urls(['submitted'])
+        print('Waiting for {} data requests of run {}'.format(len(thredds_urls), now))
+        cf.wait_for_requests(thredds_urls, rj, initial_wait=args.poll_wait)
+
+
+def status(sDir, now):
+    # counts of the requests of the run in each state, read without opening the journal for writing (the run may
+    # still be going)
+    import json
+    from functions import journal
+    requests = dict()
+    with open(journal.journal_path(sDir, now)) as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:  # record still being written
+                continue
+            entry = requests.setdefault(rec['url'], dict(outputUrl=None))
+            entry['state'] = rec['state']
+            entry['outputUrl'] = rec.get('outputUrl') or entry['outputUrl']
+    states = [e['state'] for e in requests.values()]
+    print('Run {}: {} data requests'.format(now, len(states)))
+    for state in journal.STATES:
+        print('  {:<11s} {}'.format(state, states.count(state)))
+    no_output = sum(1 for e in requests.values() if e['outputUrl'] and 'no_output_url' in e['outputUrl'])
+    if no_output:
+        print('  {} requests failed without an output url'.format(no_output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
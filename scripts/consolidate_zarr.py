@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+@brief: Optional stage that consolidates the netCDF files downloaded to sDir (by thredds_download_nc.py) into one
+time-sorted, chunked and compressed Zarr store per reference designator, delivery method and stream, saved as
+sDir/zarr/<refdes>-<method>-<stream>.zarr. The files of each stream are found in the dataset index (see
+dataset_index.py) and the streams are consolidated in a process pool. Each store remembers the files it was built
+from, so files downloaded later are appended to it instead of rebuilding it (the store is only rebuilt if the new
+data start before the end of the data already in it). Streams are read and written one chunk of time steps at a time
+rather than loaded into memory. Requires the xarray, zarr, dask and netCDF4 packages, which are only imported when
+this stage runs.
+
+@usage:
+sDir: directory where the downloaded files are saved
+refdes: optional partially- or fully-qualified reference designator to consolidate (default: all downloaded streams)
+n_workers: optional number of streams consolidated at once (default: number of CPUs)
+time_chunk: optional number of time steps in each Zarr chunk (default 100000)
+complevel: optional compression level (default 5)
+"""
+
+import importlib.util
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from . import dataset_index
+
+
+def compression_encoding(ds, time_chunk, complevel):
+    # chunk every variable along time and compress it (zarr 3 and zarr 2 take the compressor differently)
+    import zarr
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        codec = dict(compressors=(zarr.codecs.BloscCodec(cname='zstd', clevel=complevel, shuffle='bitshuffle'),))
+    else:
+        from numcodecs import Blosc
+        codec = dict(compressor=Blosc(cname='zstd', clevel=complevel, shuffle=Blosc.BITSHUFFLE))
+
+    encoding = dict()
+    for name, var in ds.variables.items():
+        if 'time' in var.dims and var.dtype.kind != 'O':
+            chunks = tuple(min(time_chunk, size) if dim == 'time' else size for dim, size in zip(var.dims, var.shape))
+            encoding[name] = dict(codec, chunks=chunks)
+    return encoding
+
+
+def consolidate_stream(store, paths, time_chunk=100000, complevel=5):
+    """
+    Write the netCDF files in paths to the Zarr store, sorted by time. If the store already exists, only the files
+    it was not built from are added. Returns the store and the number of files added.
+    """
+    import xarray as xr
+    import zarr
+
+    names = sorted(os.path.basename(p) for p in paths)
+    mode = 'w'
+    if os.path.isdir(store):
+        with xr.open_dataset(store, engine='zarr', chunks=None) as existing:
+            done = list(existing.attrs.get('source_files', []))
+            tmax = existing['time'].values.max() if existing.sizes.get('time') else None
+        new = [p for p in paths if os.path.basename(p) not in done]
+        if not new:
+            return store, 0
+        ds = open_files(new, time_chunk)
+        if tmax is not None and ds['time'].values.min() > tmax:
+            mode = 'a'
+        else:  # the new files overlap the data already in the store, build it again from every file
+            ds.close()
+            new = paths
+            ds = open_files(paths, time_chunk)
+    else:
+        new = paths
+        ds = open_files(paths, time_chunk)
+
+    try:
+        if mode == 'w':
+            ds.attrs['source_files'] = names
+            ds.to_zarr(store, mode='w', encoding=compression_encoding(ds, time_chunk, complevel), consolidated=True)
+        else:
+            ds.to_zarr(store, append_dim='time', consolidated=True)
+            group = zarr.open_group(store, mode='r+')
+            group.attrs['source_files'] = sorted(set(done) | set(names))
+            zarr.consolidate_metadata(store)
+    finally:
+        ds.close()
+    return store, len(new)
+
+
+def main(sDir, refdes=None, n_workers=None, time_chunk=100000, complevel=5):
+    if not all(importlib.util.find_spec(pkg) for pkg in ('xarray', 'zarr', 'dask', 'netCDF4')):
+        raise Exception('Consolidating downloads into Zarr stores requires the xarray, zarr, dask and netCDF4 packages')
+
+    db_path = os.path.join(sDir, 'dataset_index.db')
+    dataset_index.scan(sDir, db_path)  # pick up files that are not in the index yet
+    files = dataset_index.query(db_path, refdes=refdes)
+    files = files[files['path'].str.endswith('.nc') & files['stream'].notnull()]
+    groups = files.groupby(['refdes', 'method', 'stream'])['path'].apply(list)
+
+    outDir = os.path.join(sDir, 'zarr')
+    os.makedirs(outDir, exist_ok=True)
+    print('Consolidating {} streams into Zarr stores in {}'.format(len(groups), outDir))
+    stores = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = dict((executor.submit(consolidate_stream, os.path.join(outDir, '-'.join(key) + '.zarr'), paths,
+                                        time_chunk, complevel), key) for key, paths in groups.items())
+        for fut in as_completed(futures):
+            try:
+                store, n_added = fut.result()
+            except Exception as e:  # one unreadable stream should not stop the others
+                print('{}: consolidation failed: {}'.format('-'.join(futures[fut]), e))
+                continue
+            stores.append(store)
+            if n_added:
+                print('{}: added {} files'.format(os.path.basename(store), n_added))
+            else:
+                print('{}: up to date'.format(os.path.basename(store)))
+    return stores
+
+
+def open_files(paths, time_chunk=100000):
+    """
+    Open netCDF files of one stream lazily as a single dataset along time, sorted, without duplicate time stamps and
+    chunked time_chunk time steps at a time, so it is read and written chunk by chunk instead of loaded into memory.
+    Only the time variable is read here. Close the dataset once it has been written.
+    """
+    import xarray as xr
+
+    def by_time(ds):
+        if 'obs' in ds.dims and 'time' in ds.variables:  # uFrame files are indexed by obs, with time along obs
+            ds = ds.swap_dims({'obs': 'time'}).drop_vars('obs', errors='ignore')
+        return ds
+
+    ds = xr.open_mfdataset(paths, chunks={}, preprocess=by_time, combine='nested', concat_dim='time',
+                           data_vars='minimal', coords='minimal', compat='override')
+    unique = np.unique(ds['time'].values, return_index=True)[1]  # sorted by time
+    sorted_ds = ds.isel(time=unique)
+    sorted_ds = sorted_ds.chunk(dict((dim, time_chunk if dim == 'time' else -1) for dim in sorted_ds.dims))
+    sorted_ds.set_close(ds.close)
+    return sorted_ds
+
+
+if __name__ == '__main__':
+    sDir = '/Users/lgarzio/Documents/OOI'
+    refdes = None  # 'GI01SUMO-SBD11'
+    main(sDir, refdes)
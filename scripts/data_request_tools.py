@@ -6,10 +6,85 @@ Modified on Sep 7 2018
 @brief: This is a collection of tools for use in creating data request urls.
 """
 
+import hashlib
+import io
 import itertools
+import json
+import os
+import time
+import numpy as np
 import pandas as pd
 import datetime as dt
 import ast
+import codecs
+import re
+import requests
+from concurrent.futures import ThreadPoolExecutor
+import functions.common as cf
+from functions import metrics
+
+CATALOG_URL = cf.M2M_URL + '/api/uframe/stream'
+CATALOG_COLUMNS = ['array_name', 'array_code', 'reference_designator', 'subsite', 'node', 'sensor', 'method', 'stream',
+                   'beginTime', 'endTime', 'science']
+CATALOG_CACHE_VERSION = 2  # increase when CATALOG_COLUMNS change so old cached catalogs are not re-used
+DATABASE_URLS = ['https://raw.githubusercontent.com/seagrinch/data-team-python/master/infrastructure/data_streams.csv',
+                 'https://raw.githubusercontent.com/seagrinch/data-team-python/master/infrastructure/stream_descriptions.csv',
+                 'https://raw.githubusercontent.com/seagrinch/data-team-python/master/infrastructure/regions.csv']
+DATABASE_SNAPSHOT_VERSION = 1  # increase when build_database changes so old snapshots are not re-used
+CHUNK_SPAN_FACTORS = {'streamed': 0.1}  # streamed data arrive at much higher rates, so adaptive windows are shorter
+FILTER_COLUMNS = ['array_code', 'subsite', 'node', 'method', 'sensor']
+_database = dict()  # database built in this process
+
+
+@metrics.timed('url_build')
+def build_request_urls(specs):
+    """
+    Assemble the data request url for every row of specs (output from request_specs) as whole-column string
+    operations. Returns a list of urls in the order of the rows.
+    """
+    if specs.empty:
+        return []
+    base_url = cf.M2M_URL + '/api/m2m/12576/sensor/inv'
+    ap = '&include_annotations=true&include_provenance=true'
+    rd = specs['reference_designator'].str.split('-', n=3, expand=True)
+    urls = (base_url + '/' + rd[0] + '/' + rd[1] + '/' + rd[2] + '-' + rd[3] + '/' + specs['method'] + '/' +
+            specs['stream_name'] + '?beginDT=' + specs['beginTime'] + '&endDT=' + specs['endTime'] + ap)
+    return urls.tolist()
+
+
+def chunk_request_specs(specs, chunk_days, mode='adaptive'):
+    """
+    Split each request in specs (output from request_specs) into time windows so uFrame can fulfill the pieces in
+    parallel as smaller, independently retryable requests. mode='adaptive' (default) splits each request into the
+    fewest windows of equal length no longer than chunk_days, scaled by CHUNK_SPAN_FACTORS for high-rate delivery
+    methods. mode='fixed' cuts a window every chunk_days from beginTime (the last window may be shorter). Requests
+    shorter than one window, and requests without valid times, are left as they are.
+    """
+    if not chunk_days or specs.empty:
+        return specs
+
+    begin = pd.to_datetime(specs['beginTime'], utc=True, errors='coerce')
+    end = pd.to_datetime(specs['endTime'], utc=True, errors='coerce')
+    span = pd.Series(pd.to_timedelta(chunk_days, unit='D'), index=specs.index)
+    if mode == 'adaptive':
+        span = span * specs['method'].map(CHUNK_SPAN_FACTORS).fillna(1)
+    duration = end - begin
+    nchunks = np.ceil(duration / span).fillna(1).clip(lower=1).astype(int)
+    if mode == 'adaptive':
+        span = (duration / nchunks).dt.ceil('s').fillna(span)
+
+    rows = specs.index.repeat(nchunks)
+    chunks = specs.loc[rows].reset_index(drop=True)
+    k = chunks.groupby(rows).cumcount().values
+    first = k == 0
+    last = k == nchunks.loc[rows].values - 1
+    chunk_begin = begin.loc[rows].values + k * span.loc[rows].values
+    chunk_end = np.minimum(chunk_begin + span.loc[rows].values, end.loc[rows].values)
+
+    # keep the original begin and end times of each request, only the new boundaries are formatted
+    chunks.loc[~first, 'beginTime'] = format_times(chunk_begin[~first])
+    chunks.loc[~last, 'endTime'] = format_times(chunk_end[~last])
+    return chunks
 
 
 def check_str(x):
@@ -20,6 +95,40 @@ def check_str(x):
     return y
 
 
+def coalesce_request_specs(specs):
+    """
+    Merge the requests in specs (output from request_specs) for the same reference_designator, method and stream
+    whose time ranges overlap or touch into one request spanning all of them, and drop exact duplicates. Requests
+    without valid times are only de-duplicated. Rows keep the order in which each request first appears, and the
+    number of requests saved is printed.
+    """
+    if specs.empty:
+        return specs
+    n_requests = len(specs.index)
+    key = ['reference_designator', 'method', 'stream_name']
+    specs = specs.drop_duplicates().reset_index(drop=True)
+    begin = pd.to_datetime(specs['beginTime'], utc=True, errors='coerce')
+    end = pd.to_datetime(specs['endTime'], utc=True, errors='coerce')
+    valid = begin.notna() & end.notna()
+
+    # sort each stream's requests by beginTime: a new request starts wherever the beginTime falls after the latest
+    # endTime seen so far for that stream
+    df = specs[valid].assign(begin=begin[valid], end=end[valid]).sort_values(key + ['begin'])
+    latest_end = df.groupby(key)['end'].cummax()
+    new_stream = (df[key] != df[key].shift()).any(axis=1)
+    new_request = new_stream | (df['begin'] > latest_end.shift())
+    grouped = df.groupby(new_request.cumsum())
+    merged = specs.loc[grouped['begin'].idxmin(), key + ['beginTime']]
+    merged['endTime'] = specs.loc[grouped['end'].idxmax(), 'endTime'].values
+    merged['order'] = pd.Series(df.index, index=df.index).groupby(new_request.cumsum()).min().values
+
+    unmerged = specs[~valid].assign(order=specs.index[~valid])
+    merged = pd.concat([merged, unmerged]).sort_values('order').drop(columns='order').reset_index(drop=True)
+    print('Coalesced {} data requests into {}: {} requests saved'.format(n_requests, len(merged.index),
+                                                                        n_requests - len(merged.index)))
+    return merged
+
+
 def define_methods(delivery_method):
     valid_inputs = ['streamed', 'telemetered', 'recovered']
     dmethods = []
@@ -38,39 +147,45 @@ def define_methods(delivery_method):
     return dmethods
 
 
-def filter_dataframe(df, array, subsite, node, inst, dmethods=''):
-    df_filtered = pd.DataFrame()
+def build_filter_index(df):
+    """
+    Factorize the columns used by filter_dataframe once: for each column, the code of every row and the unique
+    values. Pass the result to filter_dataframe to filter the same DataFrame many times.
+    """
+    index = dict()
+    for col in FILTER_COLUMNS:
+        if col in df.columns:
+            codes, uniques = pd.factorize(df[col])
+            index[col] = (codes, pd.Index(uniques))
+    return index
 
-    if not array:
-        dba = df
-    else:
-        dba = df[df['array_code'].isin(array)]
 
-    if not subsite:
-        dbs = dba
-    else:
-        dbs = dba[dba['subsite'].isin(subsite)]
+@metrics.timed('filter')
+def filter_dataframe(df, array, subsite, node, inst, dmethods='', index=None):
+    """
+    Return the rows of df matching all of the selected arrays, subsites, nodes, delivery methods and (partial)
+    instruments in one pass. Instrument terms are matched against the unique sensor names only, and each row is
+    returned at most once, in its original order.
+    """
+    if index is None:
+        index = build_filter_index(df)
 
-    if not node:
-        dbn = dbs
-    else:
-        dbn = dbs[dbs['node'].isin(node)]
+    mask = np.ones(len(df), dtype=bool)
+    for col, selected in (('array_code', array), ('subsite', subsite), ('node', node), ('method', dmethods)):
+        if selected:
+            codes, uniques = index[col]
+            selected_codes = uniques.get_indexer(pd.Index(selected))
+            mask &= np.isin(codes, selected_codes[selected_codes >= 0])
 
-    if not dmethods:
-        dbd = dbn
-    else:
-        dbd = dbn[dbn['method'].isin(dmethods)]
-
-    if not inst:
-        dbi = dbd
-        df_filtered = dbi
-    else:
-        for i in inst:
-            dbi = dbd.loc[dbd.sensor.str.contains(i)]
-            if dbi.empty:
-                continue
-            df_filtered = df_filtered.append(dbi, ignore_index=True)
+    if inst:
+        codes, uniques = index['sensor']
+        pattern = re.compile('|'.join('(?:{})'.format(i) for i in inst))
+        sensor_codes = [i for i, sensor in enumerate(uniques) if pattern.search(sensor)]
+        mask &= np.isin(codes, sensor_codes)
 
+    df_filtered = df[mask]
+    if inst:
+        df_filtered = df_filtered.reset_index(drop=True)
     return df_filtered
 
 
@@ -86,6 +201,12 @@ def format_date(date_text):
     return fdate
 
 
+def format_times(times):
+    # format datetimes as uFrame request times (e.g. 2014-01-01T00:00:00.000Z)
+    times = pd.DatetimeIndex(times)
+    return (times.strftime('%Y-%m-%dT%H:%M:%S.%f').str[:-3] + 'Z').tolist()
+
+
 def format_inputs(input_str):
     if input_str == '':
         formatted_input = []
@@ -117,11 +238,7 @@ def filter_refdes(refdes_list, filter_by):
     return db
 
 
-def get_database():
-    db_inst_stream = pd.read_csv('https://raw.githubusercontent.com/seagrinch/data-team-python/master/infrastructure/data_streams.csv')
-    db_stream_desc = pd.read_csv('https://raw.githubusercontent.com/seagrinch/data-team-python/master/infrastructure/stream_descriptions.csv')
-    db_regions = pd.read_csv('https://raw.githubusercontent.com/seagrinch/data-team-python/master/infrastructure/regions.csv')
-
+def build_database(db_inst_stream, db_stream_desc, db_regions):
     db_inst_stream = db_inst_stream[['reference_designator', 'method', 'stream_name']]
     db_stream_desc = db_stream_desc.rename(columns={'name': 'stream_name'})
     db_stream_desc = db_stream_desc[['stream_name', 'stream_type']]
@@ -144,7 +261,213 @@ def get_database():
     return db
 
 
+def get_database(refresh=False):
+    """
+    Return the OOI Datateam Database. The three source files are downloaded at the same time and the merged
+    database is built once per process (refresh=True builds it again). Each build is also saved locally under the
+    hash of the source files, so a later run only downloads the sources and re-uses the saved database if they
+    have not changed.
+    """
+    if 'db' in _database and not refresh:
+        return _database['db'].copy()
+
+    with metrics.stage('database_load'):
+        session = cf.get_session(pool_size=len(DATABASE_URLS))
+        with metrics.stage('database_fetch'), ThreadPoolExecutor(max_workers=len(DATABASE_URLS)) as executor:
+            sources = list(executor.map(lambda url: get_text(session, url), DATABASE_URLS))
+
+        digest = hashlib.sha256(''.join(sources).encode('utf-8')).hexdigest()[:16]
+        fpath = os.path.join(cf.cache_dir(), 'datateam_database_v{}_{}'.format(DATABASE_SNAPSHOT_VERSION, digest))
+        db = cf.read_frame(fpath)
+        if db is None:
+            db = build_database(*[pd.read_csv(io.StringIO(x)) for x in sources])
+            cf.write_frame(db, fpath)
+
+    _database['db'] = db
+    return db.copy()
+
+
+def get_stream_catalog(refresh=False, ttl=24 * 3600, science_only=False, cache=True):
+    """
+    Return the OOI GUI data catalog (CATALOG_URL) as a DataFrame with one row per stream (see parse_stream_catalog).
+    The catalog is cached locally (see functions.common.cache_dir) and is re-used for ttl seconds. After that it is
+    revalidated with ETag/If-Modified-Since and only downloaded again if it changed. refresh=True ignores the cache.
+    science_only=True returns only the science streams; with cache=False the other streams are then dropped while
+    the catalog is being parsed.
+    """
+    fpath = os.path.join(cf.cache_dir(), 'uframe_stream_catalog_v{}'.format(CATALOG_CACHE_VERSION))
+    meta_file = fpath + '.json'
+    meta = dict()
+    catalog = None
+    if cache and not refresh and os.path.isfile(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        catalog = cf.read_frame(fpath)
+
+    if catalog is None or time.time() - meta['fetched'] >= ttl:
+        headers = dict()
+        if catalog is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        with requests.get(CATALOG_URL, headers=headers, stream=True) as r:
+            if r.status_code == 304:
+                print('GUI data catalog unchanged, using the local copy')
+            else:
+                r.raise_for_status()
+                with metrics.stage('catalog_parse'):
+                    chunks = metrics.timed_iter(r.iter_content(chunk_size=256 * 1024), 'catalog_fetch')
+                    catalog = parse_stream_catalog(chunks, science_only and not cache)
+                meta = dict(etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified'))
+                if cache:
+                    cf.write_frame(catalog, fpath)
+
+        if cache:
+            meta['fetched'] = time.time()
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f)
+
+    if science_only:
+        catalog = catalog[catalog['science']]
+    return catalog
+
+
+def get_text(session, url):
+    r = session.get(url)
+    r.raise_for_status()
+    return r.text
+
+
+def request_specs(df, begin='', end='', begin_col='beginTime', end_col='endTime'):
+    """
+    Return a DataFrame with the reference_designator, method, stream_name, beginTime and endTime to request for
+    each row of df. If a begin or end date is entered, it replaces the system times in begin_col/end_col wherever it
+    falls within them. A warning is printed for each stream where the system time is used instead.
+    """
+    sys_begin = df[begin_col].reset_index(drop=True)
+    sys_end = df[end_col].reset_index(drop=True)
+    specs = pd.DataFrame({'reference_designator': df['reference_designator'].values, 'method': df['method'].values,
+                          'stream_name': df['stream_name'].values})
+
+    # check times specified against system times
+    begin_ok = pd.Series(True, index=sys_begin.index)
+    begin_time = sys_begin
+    if begin:
+        begin_ok = (sys_begin < begin) & (sys_end > begin)
+        begin_time = sys_begin.where(~begin_ok, begin)
+
+    end_ok = pd.Series(True, index=sys_end.index)
+    end_time = sys_end
+    if end:
+        end_ok = begin_time < end
+        end_time = sys_end.where(~end_ok, end)
+
+    for i in specs.index[~(begin_ok & end_ok)]:
+        name = '{:s}-{:s}-{:s}'.format(specs['reference_designator'][i], specs['method'][i], specs['stream_name'][i])
+        if not begin_ok[i]:
+            print('{:s}: begin time entered ({:s}) is not within time ranges available in the system: '
+                  '{:s} to {:s}'.format(name, begin, sys_begin[i], sys_end[i]))
+            print('using system beginTime')
+        if not end_ok[i]:
+            print('{:s}: end time entered ({:s}) is before beginTime ({:s})'.format(name, end, sys_begin[i]))
+            print('using system endTime')
+
+    specs['beginTime'] = begin_time
+    specs['endTime'] = end_time
+    return specs
+
+
+def iter_json_array(chunks, key):
+    """
+    Incrementally decode the objects of the JSON array stored under key from an iterable of byte chunks (e.g. a
+    streamed response), yielding one object at a time without holding the whole document in memory.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    marker = '"{}"'.format(key)
+
+    # skip ahead to the opening bracket of the array
+    while True:
+        start = buf.find(marker)
+        if start >= 0:
+            start = buf.find('[', start)
+            if start >= 0:
+                buf = buf[start + 1:]
+                break
+        chunk = next(chunks, None)
+        if chunk is None:
+            return
+        buf += text.decode(chunk)
+
+    pos = 0
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf):
+            if buf[pos] == ']':
+                return
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+                yield obj
+                continue
+            except ValueError:  # the object continues in the next chunk
+                pass
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError('Unexpected end of JSON array "{}"'.format(key))
+        buf = buf[pos:] + text.decode(chunk)
+        pos = 0
+
+
+def parse_stream_catalog(chunks, science_only=False):
+    """
+    Parse the streamed GUI data catalog response into column arrays, one row per stream. The reference designator
+    is split once per row. The science column flags Science streams that are not 'bad' streams;
+    science_only=True drops every other stream while parsing.
+    """
+    columns = dict((c, []) for c in CATALOG_COLUMNS)
+    for s in iter_json_array(chunks, 'streams'):
+        science = s['stream_dataset'] == 'Science' and 'bad' not in str(s['stream_name'])
+        if science_only and not science:
+            continue
+        try:
+            method = s['stream_method'].replace('-', '_')
+        except AttributeError:  # skip if there is no method defined
+            method = 'na'
+        refdes = s['reference_designator']
+        rd = refdes.split('-')
+        columns['array_name'].append(s['array_name'])
+        columns['array_code'].append(refdes[0:2])
+        columns['reference_designator'].append(refdes)
+        columns['subsite'].append(rd[0])
+        columns['node'].append(rd[1])
+        columns['sensor'].append(rd[2] + '-' + rd[3])
+        columns['method'].append(method)
+        columns['stream'].append(s['stream'])
+        columns['beginTime'].append(s['start'])
+        columns['endTime'].append(s['end'])
+        columns['science'].append(science)
+
+    columns['science'] = np.array(columns['science'], dtype=bool)
+    return pd.DataFrame(columns, columns=CATALOG_COLUMNS)
+
+
 def refdes_format(refdes):
     rd = refdes.split('-')
     inst_format = '{:s}/{:s}/{:s}-{:s}/'.format(rd[0], rd[1], rd[2], rd[3])
-    return inst_format
\ No newline at end of file
+    return inst_format
+
+
+def science_streams(df, include_streams=(), exclude=()):
+    """
+    Return the rows of df that are Science streams or listed in include_streams, dropping any stream whose name
+    contains one of the strings in exclude.
+    """
+    mask = (df['stream_type'] == 'Science') | df['stream_name'].isin(include_streams)
+    for x in exclude:
+        mask &= ~df['stream_name'].str.contains(x, regex=False, na=False)
+    return df[mask]
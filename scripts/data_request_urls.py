@@ -18,61 +18,27 @@ inst: optional list of instruments (can be partial), or an empty list if request
 delivery_methods: optional list of methods, or an empty list if requesting all (e.g. []  or ['streamed','telemetered','recovered'])
 begin: optional start date for data request (e.g. '' or 2014-05-15T00:00:00)
 end: optional end date for data request  (e.g. '' or 2015-01-01T00:00:00)
+refresh_catalog: optional, True to download the GUI data catalog again instead of using the local copy
+chunk_days: optional maximum length (in days) of the time windows each data request is split into (e.g. None or 90),
+a tenth of that for streamed requests (see data_request_tools.chunk_request_specs)
 """
 
 
 import datetime as dt
 import os
 import pandas as pd
-import requests
 from . import data_request_tools
 import functions.common as cf
 
 
-def data_request_urls(df, begin, end):
+def data_request_urls(df, begin, end, chunk_days=None):
     '''
     :return urls for data requests of science streams that are found in the QC database
     '''
-    base_url = 'https://ooinet.oceanobservatories.org/api/m2m/12576/sensor/inv'
-    ap = '&include_annotations=true&include_provenance=true'
-    url_list = []
-    for i, j in df.iterrows():
-        if j['source'] == 'qcdb_and_gui_catalog' and j['stream_type'] == 'Science':
-
-            refdes = j['reference_designator']
-            inst_req = data_request_tools.refdes_format(refdes)
-            method = j['method']
-            stream = j['stream_name']
-
-            sys_beginTime = j['beginTime']
-            sys_endTime = j['endTime']
-
-            # check times specified against system times
-            if not begin:
-                beginTime = sys_beginTime
-            else:
-                if sys_beginTime < begin < sys_endTime:
-                    beginTime = begin
-                else:
-                    print('{:s}-{:s}-{:s}: begin time entered ({:s}) is not within time ranges available in the system: ' \
-                          '{:s} to {:s}'.format(refdes, method, stream, begin, sys_beginTime, sys_endTime))
-                    print('using system beginTime')
-                    beginTime = sys_beginTime
-
-            if not end:
-                endTime = sys_endTime
-            else:
-                if end > beginTime:
-                    endTime = end
-                else:
-                    print('{:s}-{:s}-{:s}: end time entered ({:s}) is before beginTime ' \
-                          '({:s})'.format(refdes, method, stream, end, sys_beginTime))
-                    print('using system endTime')
-                    endTime = sys_endTime
-
-            url = '{:s}/{:s}{:s}/{:s}?beginDT={:s}&endDT={:s}{:s}'.format(base_url, inst_req, method, stream, beginTime, endTime, ap)
-            url_list.append(url)
-    return url_list
+    df = data_request_tools.science_streams(df[df['source'] == 'qcdb_and_gui_catalog'])
+    specs = data_request_tools.request_specs(df, begin, end)
+    specs = data_request_tools.chunk_request_specs(specs, chunk_days)
+    return data_request_tools.build_request_urls(specs)
 
 
 def define_source(df):
@@ -83,42 +49,20 @@ def define_source(df):
     return df
 
 
-def gui_stream_list():
-    r = requests.get('https://ooinet.oceanobservatories.org/api/uframe/stream')
-    response = r.json()['streams']
+def gui_stream_list(refresh=False):
+    catalog = data_request_tools.get_stream_catalog(refresh)
 
-    gui_dict_all = {}
-    for i in range(len(response)):
-        try:
-            method = response[i]['stream_method'].replace('-', '_')
-        except AttributeError:  # skip if there is no method defined
-            method = 'na'
-
-        if not response[i]['stream']:
-            stream = 'no_stream'
-        else:
-            stream = response[i]['stream']
-
-        gui_dict_all[i] = {}
-        gui_dict_all[i]['array_name'] = response[i]['array_name']
-        refdes = response[i]['reference_designator']
-        gui_dict_all[i]['array_code'] = refdes[0:2]
-        gui_dict_all[i]['reference_designator'] = refdes
-        gui_dict_all[i]['subsite'] = refdes.split('-')[0]
-        gui_dict_all[i]['node'] = refdes.split('-')[1]
-        gui_dict_all[i]['sensor'] = refdes.split('-')[2] + '-' + refdes.split('-')[3]
-        gui_dict_all[i]['method'] = method
-        gui_dict_all[i]['stream_name'] = stream
-        gui_dict_all[i]['beginTime'] = response[i]['start']
-        gui_dict_all[i]['endTime'] = response[i]['end']
-
-    gui_df_all = pd.DataFrame.from_dict(gui_dict_all, orient='index')
+    gui_df_all = catalog[['array_name', 'array_code', 'reference_designator', 'subsite', 'node', 'sensor', 'method']].copy()
+    has_stream = catalog['stream'].notnull() & (catalog['stream'] != '')
+    gui_df_all['stream_name'] = catalog['stream'].where(has_stream, 'no_stream')
+    gui_df_all['beginTime'] = catalog['beginTime']
+    gui_df_all['endTime'] = catalog['endTime']
     gui_df_all['in_gui_catalog'] = 'yes'
 
     return gui_df_all
 
 
-def main(sDir, array, subsite, node, sensor, delivery_methods, begin, end, now):
+def main(sDir, array, subsite, node, sensor, delivery_methods, begin, end, now, refresh_catalog=False, chunk_days=None):
     cf.create_dir(sDir)
     begin = data_request_tools.format_date(begin)
     end = data_request_tools.format_date(end)
@@ -140,7 +84,7 @@ def main(sDir, array, subsite, node, sensor, delivery_methods, begin, end, now):
     if dbf.empty:
         raise Exception('\nThe selected instruments/delivery_methods are not found in the QC Database.')
     else:
-        gui_df_all = gui_stream_list()
+        gui_df_all = gui_stream_list(refresh_catalog)
         gui_df = data_request_tools.filter_dataframe(gui_df_all, array, subsite, node, sensor, dmethods)
 
         if gui_df.empty:
@@ -156,7 +100,7 @@ def main(sDir, array, subsite, node, sensor, delivery_methods, begin, end, now):
             compare_df.to_csv(os.path.join(sDir, 'compare_qcdb_gui_catalog_{}.csv'.format(now)), index=False)
             print('\nQC Database to GUI data catalog comparison complete: %s' %os.path.join(sDir, 'compare_qcdb_gui_catalog_{}.csv'.format(now)))
 
-            url_list = data_request_urls(compare_df, begin, end)
+            url_list = data_request_urls(compare_df, begin, end, chunk_days)
             urls = pd.DataFrame(url_list)
             urls.to_csv(os.path.join(sDir, 'data_request_urls_{}.csv'.format(now)), index=False, header=False)
             print('\nData request urls complete: %s' % os.path.join(sDir, 'data_request_urls_{}.csv'.format(now)))
@@ -174,4 +118,6 @@ if __name__ == '__main__':
     begin = ''  # 2014-01-01T00:00:00
     end = ''  # 2015-01-01T00:00:00
     now = dt.datetime.now().strftime('%Y%m%dT%H%M')
-    main(sDir, array, subsite, node, inst, delivery_methods, begin, end, now)
+    refresh_catalog = False
+    chunk_days = None  # 90
+    main(sDir, array, subsite, node, inst, delivery_methods, begin, end, now, refresh_catalog, chunk_days)
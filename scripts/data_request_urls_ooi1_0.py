@@ -14,93 +14,138 @@ subsite: optional list of subsites, or an empty list if requesting all (e.g. []
 node: optional list of nodes, or an empty list if requesting all (e.g. [] or ['SBD11','SBD12'])
 inst: optional list of instruments (can be partial), or an empty list if requesting all (e.g. [] or ['FLOR','CTD'])
 delivery_methods: optional list of methods, or an empty list if requesting all (e.g. []  or ['streamed','telemetered','recovered'])
+chunk_days: optional maximum length (in days) of the time windows each data request is split into (e.g. None or 90),
+a tenth of that for streamed requests (see data_request_tools.chunk_request_specs)
+
+plan_batch builds the urls for many selections (e.g. every row of data_download.csv) in one pass.
 """
 
 
 import datetime as dt
 import os
 import pandas as pd
-import csv
 from . import data_request_tools
 import functions.common as cf
 
+REVIEW_LIST_URL = 'https://raw.githubusercontent.com/ooi-data-lab/data-review-prep/master/review_list/data_review_list.csv'
+
 
-def build_data_request_urls(df):
+def build_data_request_urls(df, chunk_days=None):
     '''
     :return urls for data requests of science streams that are found in the QC database
     '''
-    base_url = 'https://ooinet.oceanobservatories.org/api/m2m/12576/sensor/inv'
-    ap = '&include_annotations=true&include_provenance=true'
-    url_list = []
-    for i, j in df.iterrows():
-        if j['stream_type'] == 'Science' or j['stream_name'] == 'glider_eng_telemetered' or j['stream_name'] == 'glider_eng_recovered':
-            if '_dark_conc_' not in j['stream_name']:
-                if '_blank' not in j['stream_name']:
-                    refdes = j['reference_designator']
-                    rd = refdes.split('-')
-                    inst_req = '{:s}/{:s}/{:s}-{:s}/'.format(rd[0], rd[1], rd[2], rd[3])
-                    method = j['method']
-                    stream = j['stream_name']
-                    beginTime = j['begin']
-                    endTime = j['end']
-                    url = '{:s}/{:s}{:s}/{:s}?beginDT={:s}&endDT={:s}{:s}'.format(base_url, inst_req, method, stream, beginTime, endTime, ap)
-                    url_list.append(url)
-    return url_list
+    specs = data_request_tools.coalesce_request_specs(data_request_specs(df))
+    specs = data_request_tools.chunk_request_specs(specs, chunk_days)
+    return data_request_tools.build_request_urls(specs)
 
 
-def main(sDir, array, subsite, node, inst, delivery_methods, now=dt.datetime.now().strftime('%Y%m%dT%H%M')):
-    cf.create_dir(sDir)
-    rl = pd.read_csv('https://raw.githubusercontent.com/ooi-data-lab/data-review-prep/master/review_list/data_review_list.csv')
-
-    dmethods = data_request_tools.define_methods(delivery_methods)
-    rlf = data_request_tools.filter_dataframe(rl, array, subsite, node, inst)
-    refdes_list = rlf['Reference Designator'].unique().tolist()
-
-    output = dict()
-    for i, r in enumerate(refdes_list):
-        rlf_refdes = rlf.loc[((rlf['Reference Designator'] == r) & (rlf['status'] == 'for review'))]
-        if not rlf_refdes.empty:
-            output[i] = {}
-            output[i]['reference_designator'] = r
-            output[i]['begin'] = data_request_tools.format_date(min(rlf_refdes['startDateTime']))
-            output[i]['end'] = data_request_tools.format_date(max(rlf_refdes['stopDateTime']))
-            dd = list(rlf_refdes['deploymentNumber'])
-            output[i]['deployments'] = [int(z) for z in dd]
-            #output[i]['deployments'] = dd
-
-    output_df = pd.DataFrame.from_dict(output, orient='index')
+def data_request_specs(df):
+    df = data_request_tools.science_streams(df, include_streams=['glider_eng_telemetered', 'glider_eng_recovered'],
+                                            exclude=['_dark_conc_', '_blank'])
+    return data_request_tools.request_specs(df, begin_col='begin', end_col='end')
+
+
+def main(sDir, array, subsite, node, inst, delivery_methods, now=dt.datetime.now().strftime('%Y%m%dT%H%M'),
+         chunk_days=None):
+    return plan_batch(sDir, [(array, subsite, node, inst, delivery_methods)], now, chunk_days)
+
 
+def plan_batch(sDir, selections, now=dt.datetime.now().strftime('%Y%m%dT%H%M'), chunk_days=None):
+    """
+    Build the data request urls for many selections at once. selections is a list of (array, subsite, node, inst,
+    delivery_methods) tuples, e.g. from read_selections. The data review list and the Datateam Database are loaded
+    and indexed once for all of the selections, and each output file is written once. Requests for the same stream
+    from overlapping selections are coalesced (see data_request_tools.coalesce_request_specs), and urls already saved
+    in the data request url file for this run (now) are not added again.
+    """
+    cf.create_dir(sDir)
+    rl = pd.read_csv(REVIEW_LIST_URL)
+    rl_index = data_request_tools.build_filter_index(rl)
+    dates = review_dates(rl)
+    db = data_request_tools.get_database()
+    db_index = data_request_tools.build_filter_index(db)
+
+    outputs = []
+    specs = []
+    for array, subsite, node, inst, delivery_methods in selections:
+        dmethods = data_request_tools.define_methods(delivery_methods)
+        rlf = data_request_tools.filter_dataframe(rl, array, subsite, node, inst, index=rl_index)
+        refdes_list = [r for r in rlf['Reference Designator'].unique() if r in dates.index]
+        output_df = dates.loc[refdes_list].reset_index()
+        outputs.append(output_df)
+
+        dbf = data_request_tools.filter_dataframe(db, array, subsite, node, inst, dmethods, index=db_index)
+        merged = pd.merge(output_df, dbf, on='reference_designator', how='outer')
+        merged.dropna(axis=0, subset=['deployments'], inplace=True)  # drop instruments that aren't 1.0 datasets
+        specs.append(data_request_specs(merged))
+
+    output_df = pd.concat(outputs, ignore_index=True)
     fpath = os.path.join(sDir, 'data_review_dates_deployments.csv')
     if os.path.isfile(fpath):
-        with open(fpath, 'a') as ff:
-            writer = csv.writer(ff)
-            for i in output:
-                writer.writerow([output[i]['reference_designator'], output[i]['begin'], output[i]['end'],
-                                 str(output[i]['deployments'])])
+        output_df.to_csv(fpath, mode='a', index=False, header=False)
     else:
         output_df.to_csv(fpath, index=False)
 
-    db = data_request_tools.get_database()
-    dbf = data_request_tools.filter_dataframe(db, array, subsite, node, inst, dmethods)
-    merged = pd.merge(output_df, dbf, on='reference_designator', how='outer')
-    merged.dropna(axis=0, subset=['deployments'], inplace=True)  # drop instruments that aren't 1.0 datasets
-
-    url_list = build_data_request_urls(merged)
-
-    urls = pd.DataFrame(url_list)
+    specs = data_request_tools.coalesce_request_specs(pd.concat(specs, ignore_index=True))
+    specs = data_request_tools.chunk_request_specs(specs, chunk_days)
+    url_list = data_request_tools.build_request_urls(specs)
 
     dpath = os.path.join(sDir, 'data_request_urls_{}.csv'.format(now))
     if os.path.isfile(dpath):
-        with open(dpath, 'a') as dd:
-            writer = csv.writer(dd)
-            for u in url_list:
-                writer.writerow([u])
+        with open(dpath) as f:
+            saved = set(line.strip() for line in f)
+        n_urls = len(url_list)
+        url_list = [u for u in url_list if u not in saved]
+        print('{} data requests are already in {}'.format(n_urls - len(url_list), dpath))
+        pd.DataFrame(url_list).to_csv(dpath, mode='a', index=False, header=False)
     else:
-        urls.to_csv(dpath, index=False, header=False)
+        pd.DataFrame(url_list).to_csv(dpath, index=False, header=False)
 
     return url_list
 
 
+def read_selections(fpath):
+    """
+    Read a csv file of data to download (columns: array, subsite, node, sensor, delivery_method,
+    reference_designator) into a list of (array, subsite, node, inst, delivery_methods) tuples for plan_batch.
+    """
+    df = pd.read_csv(fpath)
+    selections = []
+    for i, j in df.iterrows():
+        array = data_request_tools.check_str(j['array'])
+        array = data_request_tools.format_inputs(array)
+        refdes = j['reference_designator']
+        if type(refdes) == str:
+            subsite = data_request_tools.format_inputs(refdes.split('-')[0])
+            node = data_request_tools.format_inputs(refdes.split('-')[1])
+            inst = data_request_tools.format_inputs('-'.join((refdes.split('-')[2], refdes.split('-')[3])))
+        else:
+            subsite = data_request_tools.check_str(j['subsite'])
+            subsite = data_request_tools.format_inputs(subsite)
+            node = data_request_tools.check_str(j['node'])
+            node = data_request_tools.format_inputs(node)
+            inst = data_request_tools.check_str(j['sensor'])
+            inst = data_request_tools.format_inputs(inst)
+        delivery_methods = data_request_tools.check_str(j['delivery_method'])
+        delivery_methods = data_request_tools.format_inputs(delivery_methods)
+        selections.append((array, subsite, node, inst, delivery_methods))
+    return selections
+
+
+def review_dates(rl):
+    """
+    Return the begin and end dates and the deployment numbers of the instruments that are 'for review' in the data
+    review list, indexed by reference_designator.
+    """
+    rlr = rl[rl['status'] == 'for review']
+    grouped = rlr.groupby('Reference Designator', sort=False)
+    dates = pd.DataFrame({'begin': grouped['startDateTime'].min().map(data_request_tools.format_date),
+                          'end': grouped['stopDateTime'].max().map(data_request_tools.format_date),
+                          'deployments': grouped['deploymentNumber'].agg(lambda dd: [int(z) for z in dd])})
+    dates.index.name = 'reference_designator'
+    return dates
+
+
 if __name__ == '__main__':
     sDir = '/Users/lgarzio/Documents/OOI'
     array = []  # ['CP','CE']
@@ -109,4 +154,5 @@ if __name__ == '__main__':
     inst = []  # ['CTDMO,FLOR']
     delivery_methods = []  # ['streamed','telemetered,'recovered']
     now = dt.datetime.now().strftime('%Y%m%dT%H%M')
-    main(sDir, array, subsite, node, inst, delivery_methods, now)
+    chunk_days = None  # 90
+    main(sDir, array, subsite, node, inst, delivery_methods, now, chunk_days)
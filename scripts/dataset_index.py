@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+@brief: Keeps a local SQLite index of the files downloaded to sDir (saved as sDir/subsite/refdes/folder by
+thredds_download_nc.py), with one row per file: reference designator, delivery method, stream, deployment, time
+coverage, size and the data request url the file came from. thredds_download_nc.py adds files to the index as they are
+downloaded, and scan() (re)builds it from the files already on disk by reading the netCDF headers in a process pool.
+
+@usage:
+sDir: directory where the downloaded files are saved
+db_path: optional location of the index database (default: sDir/dataset_index.db)
+n_workers: optional number of processes used to read file headers when scanning
+"""
+
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+COLUMNS = ['path', 'refdes', 'method', 'stream', 'deployment', 'time_start', 'time_end', 'size', 'mtime',
+           'request_url', 'output_url']
+METHODS = 'streamed|telemetered|recovered_host|recovered_inst|recovered_wfp|recovered_cspp'
+FILE_PATTERN = re.compile(r'deployment(\d+)_([A-Z0-9]+-[A-Z0-9]+-[A-Z0-9]+-[A-Z0-9]+)-({})-(.+?)'
+                          r'(?:_(\d{{8}}T\d{{6}})(?:\.\d+)?-(\d{{8}}T\d{{6}})(?:\.\d+)?)?'
+                          r'(?:\.nc|_provenance\.json|_annotations\.json)$'.format(METHODS))
+FOLDER_PATTERN = re.compile(r'[^-]+-([A-Z0-9]+-[A-Z0-9]+-[A-Z0-9]+-[A-Z0-9]+)-({})-(.+)$'.format(METHODS))
+
+
+def add_files(db_path, records, request_url=None, output_url=None):
+    # insert or update records (from file_record), keeping urls recorded earlier if none are given now
+    conn = connect(db_path)
+    with conn:
+        for r in records:
+            r = dict(r, request_url=r.get('request_url') or request_url, output_url=r.get('output_url') or output_url)
+            conn.execute('INSERT INTO files ({0}) VALUES ({1}) ON CONFLICT(path) DO UPDATE SET {2}, '
+                         'request_url=COALESCE(excluded.request_url, files.request_url), '
+                         'output_url=COALESCE(excluded.output_url, files.output_url)'.format(
+                             ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)),
+                             ', '.join('{0}=excluded.{0}'.format(c) for c in COLUMNS[1:-2])),
+                         [r.get(c) for c in COLUMNS])
+    conn.close()
+
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, refdes TEXT, method TEXT, stream TEXT, '
+                 'deployment INTEGER, time_start TEXT, time_end TEXT, size INTEGER, mtime REAL, request_url TEXT, '
+                 'output_url TEXT)')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_stream ON files (refdes, method, stream, deployment)')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_time ON files (time_start, time_end)')
+    return conn
+
+
+def file_record(path):
+    """
+    Describe one downloaded file. The reference designator, method, stream, deployment and time coverage come from
+    the file and folder names, and for netCDF files the time coverage is taken from the file header when the netCDF4
+    package is installed.
+    """
+    record = dict(path=os.path.abspath(path), size=os.path.getsize(path), mtime=os.path.getmtime(path))
+    folder = FOLDER_PATTERN.match(os.path.basename(os.path.dirname(path)))
+    if folder:
+        record.update(refdes=folder.group(1), method=folder.group(2), stream=folder.group(3))
+
+    fname = FILE_PATTERN.match(os.path.basename(path))
+    if fname:
+        record.update(deployment=int(fname.group(1)), refdes=fname.group(2), method=fname.group(3),
+                      stream=fname.group(4), time_start=format_time(fname.group(5)),
+                      time_end=format_time(fname.group(6)))
+
+    if path.endswith('.nc'):
+        try:
+            import netCDF4
+            with netCDF4.Dataset(path) as ds:
+                attrs = ds.__dict__
+                record['time_start'] = attrs.get('time_coverage_start', record.get('time_start'))
+                record['time_end'] = attrs.get('time_coverage_end', record.get('time_end'))
+        except (ImportError, OSError):  # netCDF4 not installed or unreadable file: keep what the name tells us
+            pass
+    return record
+
+
+def format_time(t):
+    if not t:
+        return None
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.strptime(t, '%Y%m%dT%H%M%S'))
+
+
+def query(db_path, refdes=None, method=None, stream=None, deployment=None, begin=None, end=None):
+    """
+    Return the indexed files as a DataFrame. refdes can be partially-qualified (e.g. GI01SUMO-SBD11). begin and end
+    (e.g. 2016-01-01T00:00:00) select files whose time coverage overlaps that time range.
+    """
+    where = []
+    params = []
+    if refdes:
+        where.append('refdes LIKE ?')
+        params.append(refdes + '%')
+    for col, value in (('method', method), ('stream', stream), ('deployment', deployment)):
+        if value is not None:
+            where.append('{} = ?'.format(col))
+            params.append(value)
+    if begin:
+        where.append('time_end >= ?')
+        params.append(begin)
+    if end:
+        where.append('time_start <= ?')
+        params.append(end)
+
+    sql = 'SELECT * FROM files'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    conn = connect(db_path)
+    df = pd.read_sql_query(sql + ' ORDER BY refdes, method, stream, deployment, time_start', conn, params=params)
+    conn.close()
+    return df
+
+
+def scan(sDir, db_path=None, n_workers=None):
+    """
+    Add every downloaded file under sDir to the index. File headers are read in n_workers processes, and files
+    whose size and modification time have not changed since they were indexed are skipped.
+    """
+    db_path = db_path or os.path.join(sDir, 'dataset_index.db')
+    conn = connect(db_path)
+    known = dict((p, (s, m)) for p, s, m in conn.execute('SELECT path, size, mtime FROM files'))
+    conn.close()
+
+    paths = []
+    for root, dirs, files in os.walk(sDir):
+        for f in files:
+            if f.endswith(('.nc', '_provenance.json', '_annotations.json')):
+                path = os.path.abspath(os.path.join(root, f))
+                if known.get(path) != (os.path.getsize(path), os.path.getmtime(path)):
+                    paths.append(path)
+
+    print('Indexing {} files'.format(len(paths)))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        records = list(executor.map(file_record, paths, chunksize=64))
+    add_files(db_path, records)
+    return len(records)
+
+
+if __name__ == '__main__':
+    sDir = '/Users/lgarzio/Documents/OOI'
+    scan(sDir)
+    print(query(os.path.join(sDir, 'dataset_index.db'), refdes='GI03FLMA'))
@@ -4,48 +4,32 @@ Created on 10/17/2017
 Modified on 10/4/2018
 
 @author: Lori Garzio
-@brief: This script is used to export annotations from uFrame to a csv
+@brief: This script is used to export annotations from uFrame to a csv, and to a typed columnar file with the same
+name (parquet, or pickle if pyarrow is not installed) that annotation_index.py loads for time-range queries. The csv
+is appended to, and the columnar file is rebuilt from the whole csv after each run
 @usage:
 username: username to access the OOI API
 token: password to access the OOI API
 refdes: string of partially- (e.g. GS01SUMO) or fully-qualified (e.g. GS01SUMO-SBD11-06-METBKA000) reference designators
         or '' if requesting all annotations. Can be multiple, i.e. 'GS01SUMO, GI01SUMO-SBD11, GI01SUMO-SBD12'
 saveDir: location to save output
+n_workers: optional number of annotation requests in flight at once (default 10)
 """
 
-import requests
+import ast
+import collections
 import os
-import csv
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from . import data_request_tools
+import pandas as pd
+from . import sensor_inventory
 import functions.common as cf
 
-
-def get_ids(username, token, session):
-    # get a list of valid annotation IDs in uFrame (for writing all annotations)
-    id_url = 'https://ooinet.oceanobservatories.org/api/m2m/12580/anno?max_100&select_id&start_id='
-    for x in range(100):
-        if x == 0:
-            start_id = 0
-            IDurl = id_url + str(start_id)
-            response = get_response(IDurl, username, token, session)
-            ids = sorted(response.json())
-            if len(ids) < 100:
-                loop_ids = ids
-                return loop_ids
-            else:
-                loop_ids = ids
-                start_id = ids[-1] + 1
-        else:
-            IDurl = id_url + str(start_id)
-            response = get_response(IDurl, username, token, session)
-            ids = sorted(response.json())
-            if len(ids) < 100:
-                loop_ids = loop_ids + ids
-                return loop_ids
-            else:
-                loop_ids = loop_ids + ids
-                start_id = ids[-1] + 1
+ANNO_URL = cf.M2M_URL + '/api/m2m/12580/anno'
+COLUMNS = ['id', 'subsite', 'node', 'sensor', 'stream', 'method', 'parameters', 'beginDate', 'endDate', 'beginDT',
+           'endDT', 'exclusionFlag', 'qcFlag', 'source', 'annotation']
 
 
 def get_response(url, username, token, session):
@@ -53,65 +37,128 @@ def get_response(url, username, token, session):
     return response
 
 
-def write_all_annotations(username, token, f, session):
-    # write annotations if no reference designator is specified
-    anno_url = 'https://ooinet.oceanobservatories.org/api/m2m/12580/anno/'
-    loop_ids = get_ids(username, token, session)
+def iter_id_pages(username, token, session):
+    # yield the valid annotation IDs in uFrame 100 at a time, in ascending order
+    id_url = ANNO_URL + '?max_100&select_id&start_id='
+    start_id = 0
+    for x in range(100):
+        IDurl = id_url + str(start_id)
+        response = get_response(IDurl, username, token, session)
+        ids = sorted(response.json())
+        yield ids
+        if len(ids) < 100:
+            return
+        start_id = ids[-1] + 1
+
+
+def get_all_annotations(username, token, session, n_workers=10, callback=None):
+    """
+    Get annotations if no reference designator is specified. The annotation IDs are paged through in a separate
+    thread while n_workers threads fetch the annotations already found. callback (optional) is called with each batch
+    of annotations as soon as every annotation before it is done, so the batches follow ID order. Returns the
+    annotations in ID order.
+    """
+    anno_url = ANNO_URL + '/'
+    id_queue = queue.Queue(maxsize=1000)
+    errors = []  # an exception raised while paging, re-raised once the annotations already found are fetched
+
+    def page_ids():
+        try:
+            for ids in iter_id_pages(username, token, session):
+                for x in ids:
+                    id_queue.put(x)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            id_queue.put(None)
+
+    pager = threading.Thread(target=page_ids, daemon=True)
+    pager.start()
     print('Writing annotations')
 
-    for x in loop_ids:
-        url = anno_url + str(x)
-        anno = get_response(url, username, token, session)
-        if anno.status_code == 200:  # only write info if there is a valid response
-            info = anno.json()
-            beginDate = datetime.utcfromtimestamp(float(info['beginDT'])/1000).strftime('%Y-%m-%dT%H:%M:%S')
-            try:
-                endDate = datetime.utcfromtimestamp(float(info['endDT'])/1000).strftime('%Y-%m-%dT%H:%M:%S')
-            except TypeError:  # if end date is blank
-                endDate = None
-
-            writer = csv.writer(f)
-            newline = [info['id'], info['subsite'], info['node'], info['sensor'], info['stream'], info['method'],
-                       info['parameters'], beginDate, endDate, info['beginDT'], info['endDT'], info['exclusionFlag'],
-                       info['qcFlag'], info['source'], info['annotation'].encode('utf-8')]
-            writer.writerow(newline)
-
-
-def write_refdes_annotations(username, token, refdes_list, outfile, session):
-    # write annotations if any reference designator is specified
-    anno_url = 'https://ooinet.oceanobservatories.org/api/m2m/12580/anno/find'
+    annotations = []
+    in_flight = collections.deque()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        while True:
+            x = id_queue.get()
+            if x is not None:
+                in_flight.append(executor.submit(get_response, anno_url + str(x), username, token, session))
+            # collect finished annotations in the order they were requested (ascending ID)
+            batch = []
+            while in_flight and (in_flight[0].done() or len(in_flight) >= n_workers * 4 or x is None):
+                anno = in_flight.popleft().result()
+                if anno.status_code == 200:  # only keep info if there is a valid response
+                    batch.append(anno.json())
+            if batch:
+                annotations.extend(batch)
+                if callback:
+                    callback(batch)
+            if x is None:
+                break
+    pager.join()
+    if errors:
+        raise errors[0]
+    return annotations
+
+
+def get_refdes_annotations(username, token, refdes_list, session, n_workers=10, callback=None):
+    # get annotations if any reference designator is specified, callback (optional) is called with the new
+    # annotations of each reference designator in the order of refdes_list
+    anno_url = ANNO_URL + '/find'
     today_date = int(datetime.now().strftime("%s")) * 1000 # current date
     print ('Writing annotations')
 
-    id_list = []
-    for x in refdes_list:
+    def find(x):
         get_params = {
         "beginDT": 1356998400000,  # 2013-01-01T00:00:00
         "endDT": today_date,
         "refdes": x
         }
-
-        response = session.get(anno_url, auth=(username, token), params=get_params)
-        if response.status_code == 200:
-            data = response.json()
-
-            for d in data:
-                if d['id'] not in id_list:  # write annotation only if it hasn't already been written
-                    id_list.append(d['id'])
-                    beginDate = datetime.utcfromtimestamp(float(d['beginDT'])/1000).strftime('%Y-%m-%dT%H:%M:%S')
-                    try:
-                        endDate = datetime.utcfromtimestamp(float(d['endDT'])/1000).strftime('%Y-%m-%dT%H:%M:%S')
-                    except TypeError:  # if end date is blank
-                        endDate = None
-                    writer = csv.writer(outfile)
-                    writer.writerow([d['id'], d['subsite'], d['node'], d['sensor'], d['stream'], d['method'],
-                                     d['parameters'], beginDate, endDate, d['beginDT'], d['endDT'], d['exclusionFlag'],
-                                     d['source'], d['annotation'].encode('utf-8')])
-
-
-def main(username, token, refdes, saveDir):
+        return session.get(anno_url, auth=(username, token), params=get_params)
+
+    id_list = set()
+    annotations = []
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for response in executor.map(find, refdes_list):
+            if response.status_code == 200:
+                data = response.json()
+
+                batch = []
+                for d in data:
+                    if d['id'] not in id_list:  # keep annotation only if it hasn't already been found
+                        id_list.add(d['id'])
+                        batch.append(d)
+                annotations.extend(batch)
+                if batch and callback:
+                    callback(batch)
+    return annotations
+
+
+def annotation_frame(annotations):
+    """
+    Typed DataFrame of annotations (as returned by uFrame): beginDT and endDT stay in milliseconds (nullable
+    integers, endDT is missing for open-ended annotations), beginDate and endDate are datetimes converted from them
+    all at once, parameters is a list of parameter IDs (empty if the annotation applies to all parameters) and
+    annotation is the text.
+    """
+    df = pd.DataFrame.from_records(annotations, columns=[c for c in COLUMNS if c not in ('beginDate', 'endDate')])
+    for col in ('beginDT', 'endDT'):
+        df[col] = pd.to_numeric(df[col]).astype('Int64')
+    df['beginDate'] = pd.to_datetime(df['beginDT'].astype('float64'), unit='ms')
+    df['endDate'] = pd.to_datetime(df['endDT'].astype('float64'), unit='ms')
+    df['exclusionFlag'] = df['exclusionFlag'].fillna(False).astype(bool)
+    df['parameters'] = [list(p) if isinstance(p, (list, tuple)) else [] for p in df['parameters']]
+    df['annotation'] = df['annotation'].fillna('').astype(str)
+    return df[COLUMNS]
+
+
+def main(username, token, refdes, saveDir, n_workers=10):
+    """
+    Append the annotations to a csv file in saveDir as they arrive, then save every annotation in the csv (from this
+    and earlier runs, see read_csv) as a typed columnar file with the same name (see functions.common.write_frame),
+    which annotation_index.load() reads. Returns the annotations of this run as a DataFrame.
+    """
     cf.create_dir(saveDir)
-    sensor_inv = 'https://ooinet.oceanobservatories.org/api/m2m/12576/sensor/inv/'
 
     if not refdes:
         f = 'uframe_annotations_all.csv'
@@ -122,41 +169,49 @@ def main(username, token, refdes, saveDir):
 
     fN = os.path.join(saveDir, f)
 
-    session = requests.session() # open the connection and leave it open for the session
+    session = cf.get_session(pool_size=n_workers)  # pooled connections, left open and shared by all threads
+    new_file = not os.path.isfile(fN) or os.path.getsize(fN) == 0
     with open(fN, 'a') as outfile:
-        writer = csv.writer(outfile)
-        writer.writerow(['id', 'subsite', 'node', 'sensor', 'stream', 'method', 'parameters', 'beginDate', 'endDate',
-                         'beginDT', 'endDT', 'exclusionFlag', 'qcFlag', 'source', 'annotation'])
+        if new_file:
+            pd.DataFrame(columns=COLUMNS).to_csv(outfile, index=False)
+
+        def write_rows(batch):
+            write_csv(batch, outfile)
 
         if not refdes:  # if no refdes specified, provide all annotations
-            write_all_annotations(username, token, outfile, session)
+            annotations = get_all_annotations(username, token, session, n_workers, callback=write_rows)
         else:
-            refdes_list = []
-            frefdes = data_request_tools.format_inputs(refdes)
-            for i in frefdes:
-                print(i)
-                if len(i) == 8:
-                    url = sensor_inv + i
-                    node_info = session.get(url, auth=(username, token))
-                    nodes = node_info.json()
-                    for n in nodes:
-                        url2 = url + '/' + n
-                        sensor_info = session.get(url2, auth=(username, token))
-                        sensors = sensor_info.json()
-                        for s in sensors:
-                            refdes = '-'.join([i, n, s])
-                            refdes_list.append(refdes)
-                elif len(i) == 14:
-                    url = sensor_inv + i.split('-')[0] + '/' + i.split('-')[1]
-                    sensor_info = session.get(url, auth=(username, token))
-                    sensors = sensor_info.json()
-                    for s in sensors:
-                        refdes = '-'.join([i, s])
-                        refdes_list.append(refdes)
-                elif len(i) == 27:
-                    refdes_list.append(i)
-            refdes_unique = sorted(list(set(refdes_list)))
-            write_refdes_annotations(username, token, refdes_unique, outfile, session)
+            # partially-qualified reference designators are expanded from the cached sensor inventory
+            refdes_unique = sensor_inventory.main(username, token, refdes, session)
+            annotations = get_refdes_annotations(username, token, refdes_unique, session, n_workers,
+                                                 callback=write_rows)
+
+    cf.write_frame(read_csv(fN), os.path.splitext(fN)[0])
+    return annotation_frame(annotations)
+
+
+def read_csv(fN):
+    """
+    Typed DataFrame (see annotation_frame) of the annotations in a csv written by main. Header rows repeated by
+    earlier versions of this script are dropped, and an annotation saved by more than one run is kept once (its
+    latest copy).
+    """
+    df = pd.read_csv(fN, dtype=str, keep_default_na=False)
+    df = df[df['id'] != 'id'].drop_duplicates('id', keep='last')
+    df['id'] = df['id'].astype(int)
+    df['exclusionFlag'] = df['exclusionFlag'] == 'True'
+    df['parameters'] = [ast.literal_eval(p) if p else [] for p in df['parameters']]
+    records = df.drop(columns=['beginDate', 'endDate']).to_dict('records')
+    return annotation_frame([dict((k, None if v == '' else v) for k, v in r.items()) for r in records])
+
+
+def write_csv(annotations, outfile):
+    # append rows of annotations (as returned by uFrame) to an open csv file, with the dates as 2016-01-01T00:00:00
+    df = annotation_frame(annotations)
+    for col in ('beginDate', 'endDate'):
+        df[col] = df[col].dt.strftime('%Y-%m-%dT%H:%M:%S')
+    df.to_csv(outfile, index=False, header=False)
+    outfile.flush()
 
 
 if __name__ == '__main__':
@@ -164,4 +219,5 @@ if __name__ == '__main__':
     token = 'token'
     refdes = ''  # 'GS01SUMO, GS01SUMO-SBD11, GS01SUMO-SBD11-06-METBKA000'
     saveDir = '/Users/lgarzio/Documents/OOI/Annotations'
-    main(username, token, refdes, saveDir)
+    n_workers = 10
+    main(username, token, refdes, saveDir, n_workers)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+@brief: Downloads only selected variables (and optionally a time range) of the netCDF files of fulfilled data requests
+through the THREDDS OPeNDAP endpoint (thredds/dodsC) instead of whole files from thredds/fileServer. The time
+variable is always included. Each subset is saved as a compressed netCDF file with the name of the original file,
+in the same folder structure as thredds_download_nc.py (sDir/subsite/refdes/folder), so use a different sDir than
+for full downloads. The files of a request are subset in parallel worker processes, and files whose time range
+(from their name) is outside the time range requested are not opened at all. Requires the xarray and netCDF4
+packages, which are only imported when files are subset.
+
+@usage:
+sDir: local directory to which files are saved
+thredds_urls: file or list containing THREDDS directories (outputUrls) of fulfilled data requests
+variables: list or comma-separated string of the variables to download (e.g. 'pressure, ctdbp_seawater_temperature')
+begin: optional start of the time range to download (e.g. 2016-01-01T00:00:00)
+end: optional end of the time range to download
+n_workers: optional number of files subset at once (default 4)
+"""
+
+import importlib.util
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import functions.common as cf
+from functions import metrics
+from . import data_request_tools
+from . import dataset_index
+from . import thredds_download_nc
+
+
+def file_in_range(file_name, begin=None, end=None):
+    # check the time range in the file name (if it has one) against begin and end
+    fname = dataset_index.FILE_PATTERN.match(file_name)
+    if not fname or not fname.group(5):
+        return True
+    time_start = dataset_index.format_time(fname.group(5))
+    time_end = dataset_index.format_time(fname.group(6))
+    return (not begin or time_end >= begin) and (not end or time_start <= end)
+
+
+def format_time(t):
+    # datetime64 of a date string (e.g. 2016-01-01T00:00:00), or None
+    if not t:
+        return None
+    return np.datetime64(pd.Timestamp(t).to_datetime64(), 'ns')
+
+
+def main(sDir, thredds_urls, variables, begin='', end='', n_workers=4):
+    if not all(importlib.util.find_spec(pkg) for pkg in ('xarray', 'netCDF4')):
+        raise Exception('Subsetting files through OPeNDAP requires the xarray and netCDF4 packages')
+
+    cf.create_dir(sDir)
+    variables = data_request_tools.format_inputs(variables)
+    begin = data_request_tools.format_date(begin)[:19]  # checks the format, compared as 2016-01-01T00:00:00
+    end = data_request_tools.format_date(end)[:19]
+    if type(thredds_urls) == list:
+        thredds_list = thredds_urls
+    else:
+        thredds_file = pd.read_csv(os.path.join(sDir, thredds_urls))
+        thredds_list = thredds_file['outputUrl'].tolist()
+
+    # wait for all of the data requests at once, then subset the ones that fulfilled
+    fulfilled = cf.wait_for_requests(thredds_list)
+    session = cf.get_session(pool_size=n_workers)
+    total_bytes = 0
+    stime = time.time()
+    not_fulfilled = []
+    for t in thredds_list:
+        if not fulfilled.get(t):
+            not_fulfilled.append(t)
+            continue
+        print(t)
+        total_bytes += subset_request(sDir, t, variables, begin, end, session, n_workers)
+    print('\nSubset {} data requests: {}'.format(len(thredds_list) - len(not_fulfilled),
+                                                 format_saved(total_bytes, time.time() - stime)))
+    if not_fulfilled:
+        print('\n{} data requests were not subset because they did not fulfill:'.format(len(not_fulfilled)))
+        for t in not_fulfilled:
+            print(t)
+
+
+def format_saved(nbytes, etime):
+    # sizes are of the saved (compressed) files, not of the data transferred over OPeNDAP
+    return '%.2f MB saved in %.2f seconds' % (nbytes / 1e6, etime)
+
+
+def subset_file(dods_url, file_name, variables, begin=None, end=None, complevel=4):
+    """
+    Download the variables (plus time) of one file through OPeNDAP to file_name, keeping only the data between
+    begin and end (if given). Only the requested variables, and only the slice of them in the time range, are
+    transferred. Returns the size of the saved file (0 if there is no data in the time range).
+    """
+    import xarray as xr
+
+    with xr.open_dataset(dods_url) as ds:
+        missing = [v for v in variables if v not in ds.variables]
+        if missing:
+            print('{}: variables not found: {}'.format(os.path.basename(file_name), ', '.join(missing)))
+        keep = ['time'] + [v for v in variables if v in ds.variables and v != 'time']
+        sub = ds[keep]
+        if begin or end:
+            dim = ds['time'].dims[0]
+            times = ds['time'].values  # only the time variable is transferred to find the slice
+            i0 = np.searchsorted(times, format_time(begin)) if begin else 0
+            i1 = np.searchsorted(times, format_time(end), side='right') if end else len(times)
+            sub = sub.isel({dim: slice(i0, i1)})
+        if sub['time'].size == 0:
+            return 0
+        sub = sub.load()
+
+    encoding = dict((v, dict(zlib=True, complevel=complevel)) for v in sub.variables if sub[v].dtype.kind in 'biuf')
+    sub.to_netcdf(file_name + '.part', format='NETCDF4', engine='netcdf4', encoding=encoding)
+    os.replace(file_name + '.part', file_name)
+    return os.path.getsize(file_name)
+
+
+def subset_request(sDir, t, variables, begin='', end='', session=None, n_workers=4, server_url=cf.OPENDAP_URL):
+    """
+    Subset every netCDF file of the fulfilled data request t (its outputUrl) in n_workers processes. Returns the
+    total size of the saved files.
+    """
+    print('Downloading {} from files'.format(', '.join(variables)))
+    folder = t.split('/')[-2]
+    subsite = folder.split('-')[1]
+    refdes = '-'.join((subsite, folder.split('-')[2], folder.split('-')[3], folder.split('-')[4]))
+    output_dir = os.path.join(sDir, subsite, refdes, folder)
+    cf.create_dir(output_dir)
+
+    with metrics.stage('thredds_catalog'):
+        entries = thredds_download_nc.get_catalog(t.replace('.html', '.xml'), session)
+    paths = [d['urlPath'] for d in entries if d['urlPath'].endswith('.nc')]
+    in_range = [p for p in paths if file_in_range(os.path.basename(p), begin, end)]
+    if len(in_range) < len(paths):
+        print('Skipping {} files outside of the time range requested'.format(len(paths) - len(in_range)))
+
+    total_bytes = 0
+    stime = time.time()
+    with metrics.stage('subset'), ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = dict((executor.submit(subset_file, '/'.join((server_url, 'thredds/dodsC', p)),
+                                        os.path.join(output_dir, os.path.basename(p)), variables, begin, end), p)
+                       for p in in_range)
+        for fut in as_completed(futures):
+            name = os.path.basename(futures[fut])
+            try:
+                nbytes = fut.result()
+            except Exception as e:  # one failed file should not stop the rest of the request
+                print('{}: subset failed: {}'.format(name, e))
+                continue
+            if nbytes:
+                print('{}: saved {:.2f} MB'.format(name, nbytes / 1e6))
+            else:
+                print('{}: no data in the time range requested'.format(name))
+            total_bytes += nbytes
+    metrics.count('subset_bytes_saved', total_bytes)
+    print('Subset {} files: {}'.format(len(in_range), format_saved(total_bytes, time.time() - stime)))
+    return total_bytes
+
+
+if __name__ == '__main__':
+    sDir = '/Users/lgarzio/Documents/OOI/subsets'
+    thredds_urls = 'data_request_summary_20180910T1200.csv'
+    variables = 'time, pressure, ctdbp_seawater_temperature'
+    begin = ''  # 2016-01-01T00:00:00
+    end = ''  # 2016-06-01T00:00:00
+    main(sDir, thredds_urls, variables, begin, end)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+@brief: This script sends data requests, waits for them to fulfill and downloads the netCDF, provenance, and
+annotation files to a local directory as one streaming pipeline. Each request moves on to the download stage as soon
+as its status.txt appears, so sending, polling and downloading all overlap. Bounded queues between the stages keep
+a slow stage from piling up work in memory.
+
+@usage:
+sDir: directory where outputs are saved
+urls: file or list containing urls to send
+username: OOI API username
+token: OOI API password
+n_send: number of data requests in flight at once
+n_download: number of fulfilled requests downloaded at once
+queue_size: maximum number of requests waiting between two stages
+resume: optional, if True pick up the run started at now from its request journal (request_journal_<now>.jsonl):
+requests that were never sent are sent, sent requests are polled and fulfilled requests are downloaded, while
+requests that were already downloaded are left alone
+poll_wait: optional seconds before a request's status is checked again (doubles after every check, default 30)
+retry_wait: optional maximum seconds before a request rejected by uFrame is re-sent (default 60)
+confirm: optional, if False start without asking for confirmation first (e.g. for scheduled jobs)
+"""
+
+import datetime as dt
+import queue
+import threading
+import time
+import functions.common as cf
+from functions import journal
+from . import send_data_requests_nc
+from . import thredds_download_nc
+
+
+def send_stage(sDir, url_list, username, token, now, n_send, sent, rj, retry_wait=60):
+    try:
+        return send_data_requests_nc.send_all(sDir, url_list, username, token, now, n_send,
+                                              callback=lambda url, t: sent.put((url, t)), rj=rj, retry_wait=retry_wait)
+    finally:
+        sent.put(None)
+
+
+def poll_stage(sent, fulfilled, n_download, rj, waiting=(), ready=(), poll_wait=30):
+    # waiting and ready are (request url, outputUrl) pairs of a resumed run that were already sent or fulfilled
+    poller = cf.RequestPoller(initial_wait=poll_wait)
+    request_urls = dict()
+
+    def feed():
+        for url, t in waiting:
+            request_urls[t] = url
+            poller.add(t)
+        while True:
+            item = sent.get()
+            if item is None:
+                break
+            url, t = item
+            if 'no_output_url' not in t:
+                request_urls[t] = url
+                poller.add(t)
+        poller.close()
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        for item in ready:
+            fulfilled.put(item)
+        for t, done in poller:
+            if done:
+                print('\nData request has fulfilled: {}'.format(t))
+                rj.record(request_urls[t], 'fulfilled', t)
+                fulfilled.put((request_urls[t], t))
+            else:
+                print('\nData request timed out before fulfilling: {}'.format(t))
+        feeder.join()
+    finally:  # stop the download threads even if polling failed
+        for i in range(n_download):
+            fulfilled.put(None)
+
+
+def download_stage(sDir, fulfilled, session, rj):
+    while True:
+        item = fulfilled.get()
+        if item is None:
+            break
+        url, t = item
+        try:
+            thredds_download_nc.download_request(sDir, t, session, request_url=url)
+            rj.record(url, 'downloaded', t)
+        except Exception as e:  # one failed download should not stop the pipeline
+            print('Download failed for {}: {}'.format(t, e))
+
+
+def main(sDir, urls, username, token, now, n_send=5, n_download=2, queue_size=20, resume=False, poll_wait=30,
+         retry_wait=60, confirm=True):
+    cf.create_dir(sDir)
+    rj, url_list = send_data_requests_nc.open_journal(sDir, urls, now, resume)
+    if confirm:
+        cont = input('\nThere are {} requests to send, are you sure you want to continue? y/<n>: '.format(len(url_list))) or 'n'
+    else:
+        print('\nSending {} requests'.format(len(url_list)))
+        cont = 'y'
+
+    if 'y' in cont:
+        stime = time.time()
+        sent = queue.Queue(maxsize=queue_size)
+        fulfilled = queue.Queue(maxsize=queue_size)
+        session = cf.get_session(pool_size=n_download * 4)
+        result = dict()
+        if not resume:
+            for url in url_list:
+                rj.record(url, 'planned')
+        waiting = [(u, rj.requests[u]['outputUrl']) for u in rj.urls('submitted')
+                   if 'no_output_url' not in rj.requests[u]['outputUrl']]
+        ready = [(u, rj.requests[u]['outputUrl']) for u in rj.urls('fulfilled')]
+
+        def run_send():
+            result['thredds_urls'] = send_stage(sDir, url_list, username, token, now, n_send, sent, rj, retry_wait)
+
+        threads = [threading.Thread(target=run_send),
+                   threading.Thread(target=poll_stage, args=(sent, fulfilled, n_download, rj, waiting, ready, poll_wait))]
+        threads.extend([threading.Thread(target=download_stage, args=(sDir, fulfilled, session, rj))
+                        for i in range(n_download)])
+        with rj:
+            for th in threads:
+                th.start()
+            for th in threads:
+                th.join()
+
+        etime = time.time() - stime
+        if etime < 60:
+            print('\nTime elapsed sending, fulfilling and downloading data requests: %.2f seconds' % etime)
+        else:
+            mins = etime/60
+            print('\nTime elapsed sending, fulfilling and downloading data requests: %.2f minutes' % mins)
+
+        return result.get('thredds_urls')
+
+    else:
+        send_data_requests_nc.cancel_journal(rj)
+        print('\nCancelling data requests.')
+
+
+if __name__ == '__main__':
+    sDir = '/Users/lgarzio/Documents/OOI'
+    urls = 'data_request_urls_20180907T0916.csv'
+    username = 'username'
+    token = 'token'
+    now = dt.datetime.now().strftime('%Y%m%dT%H%M')
+    resume = False
+    if resume:
+        now = journal.latest_run(sDir)
+    main(sDir, urls, username, token, now, resume=resume)
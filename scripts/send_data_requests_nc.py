@@ -11,19 +11,35 @@ sDir: directory where data_request_urls.csv is located, also location to save su
 urls: file or list containing urls to send
 username: OOI API username
 token: OOI API password
+n_workers: optional number of data requests in flight at once (default 5)
+resume: optional, if True pick up the run started at now from its request journal (request_journal_<now>.jsonl)
+without re-sending requests that were already sent
+retry_wait: optional maximum seconds before a request rejected by uFrame is re-sent (default 60), the wait starts at
+2 seconds and doubles with each rejection
+confirm: optional, if False send the requests without asking for confirmation first (e.g. for scheduled jobs)
 """
 
 import datetime as dt
 import os
-import requests
+import heapq
 import pandas as pd
 import csv
+import requests
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import functions.common as cf
+from functions import journal
+from functions import metrics
+from functions import rate_control
 
 
 def define_status_outputUrl(r):
-    response = r.json()
+    if r is None:
+        print('Data request failed')
+        print('Error: no response from uFrame')
+        return 'Data request failed: no response from uFrame', 'no_output_url'
+
+    response = response_json(r)
     if r.status_code == 200:
         print('Data request sent')
 
@@ -41,64 +57,237 @@ def define_status_outputUrl(r):
         print('Data request failed')
         outputUrl = 'no_output_url'
 
-        print('Error: {} {}'.format(r.status_code, response['message']))
+        print('Error: {} {}'.format(r.status_code, response.get('message')))
 
         try:
             status = response['message']['status']
             print(status)
-        except TypeError:
+        except (TypeError, KeyError):
             status = 'Data request failed: no uFrame status provided'
 
     return status, outputUrl
 
 
-def main(sDir, urls, username, token, now):
-    cf.create_dir(sDir)
+def response_json(r):
+    # uFrame answers in json, but a proxy in front of it can answer a 5xx with an html page
+    try:
+        return r.json()
+    except ValueError:
+        return dict(message=r.text[:200])
+
+
+def send_request(session, url, username, token, rate=None):
+    """
+    Send one data request once the rate controller rate (optional, see functions/rate_control.py) allows it, and
+    report the response (or the lack of one) back to it.
+    """
+    if rate:
+        rate.acquire()
+    stime = time.time()
+    try:
+        with metrics.stage('submit'):
+            r = session.get(url, auth=(username, token))
+    except requests.exceptions.RequestException:
+        if rate:
+            rate.record(None, time.time() - stime)
+        raise
+    if rate:
+        rate.record(r.status_code, time.time() - stime, rate_control.retry_after(r))
+    return r
+
+
+def send_requests(url_list, username, token, session=None, n_workers=5, retry_wait=60, rate=None, policy=None):
+    """
+    Send data requests with at most n_workers in flight, yielding (index, url, response) as each one completes.
+    Requests are paced by the rate controller rate (a new one by default), which speeds up while uFrame keeps up and
+    slows down when it rejects requests or answers slowly. Requests rejected by uFrame (400, 429 or 5xx) or that get
+    no response are re-sent with exponential backoff of up to retry_wait seconds (or after the Retry-After given by
+    the server) without occupying a worker while they wait, so a busy stream does not hold up the rest of the list.
+    A request is given up (and yielded with its last response, None if there was none) when it runs out of attempts
+    or time under the retry policy (default: 10 attempts within an hour).
+    """
+    if session is None:
+        session = cf.get_session(pool_size=n_workers)
+    if rate is None:
+        rate = rate_control.RateController(burst=n_workers, name='submit')
+    if policy is None:
+        policy = rate_control.RetryPolicy(max_wait=retry_wait)
+
+    pending = dict()
+    retries = []  # heap of (time to re-send, index)
+    attempts = dict()  # index: [number of attempts, time of first attempt]
+    next_idx = 0
+
+    def submit(i):
+        attempts.setdefault(i, [0, time.time()])[0] += 1
+        pending[executor.submit(send_request, session, url_list[i], username, token, rate)] = i
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        while next_idx < len(url_list) or pending or retries:
+            while retries and retries[0][0] <= time.time() and len(pending) < n_workers:
+                i = heapq.heappop(retries)[1]
+                print('Re-sending request: %s' % url_list[i])
+                submit(i)
+
+            while next_idx < len(url_list) and len(pending) < n_workers:
+                print('\nRequest url {} of {}: {}'.format(next_idx + 1, len(url_list), url_list[next_idx]))
+                submit(next_idx)
+                next_idx += 1
+
+            timeout = None
+            if retries:
+                timeout = max(0, retries[0][0] - time.time())
+            if not pending:
+                time.sleep(timeout)
+                continue
+
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for fut in done:
+                i = pending.pop(fut)
+                try:
+                    r = fut.result()
+                except requests.exceptions.RequestException as e:
+                    r = None
+                    print('\nData request failed: %s' % url_list[i])
+                    print('Error: %s' % e)
+                else:
+                    if r.status_code not in rate_control.THROTTLE_CODES:
+                        yield i, url_list[i], r
+                        continue
+                    print('\nData request failed: %s' % url_list[i])
+                    print('Status from uFrame: {} {}'.format(r.status_code, uframe_status(r)))
+
+                n, started = attempts[i]
+                if policy.give_up(n, started):
+                    print('Giving up on request after {} attempts'.format(n))
+                    metrics.count('requests_abandoned')
+                    yield i, url_list[i], r
+                    continue
+                wait_time = policy.wait(n, rate_control.retry_after(r))
+                print('Trying request again in {:.0f} seconds'.format(wait_time))
+                metrics.count('requests_retried')
+                heapq.heappush(retries, (time.time() + wait_time, i))
+
+
+def uframe_status(r):
+    # the status message of a request rejected by uFrame
+    message = response_json(r).get('message')
+    try:
+        return message['status']
+    except (TypeError, KeyError):
+        return message
+
+
+def load_urls(sDir, urls):
     if type(urls) == list:
         url_list = urls
     else:
         url_file = pd.read_csv(os.path.join(sDir, urls), header=None)
         url_list = url_file[0].tolist()
-    cont = input('\nThere are {} requests to send, are you sure you want to continue? y/<n>: '.format(len(url_list))) or 'n'
+    return url_list
+
+
+def open_journal(sDir, urls, now, resume=False):
+    """
+    Open the request journal of the run (see functions/journal.py) and return it with the list of urls to send. With
+    resume=True the journal of the run is replayed and only the requests that were never sent, or that uFrame did not
+    accept, are returned (urls is ignored). Without resume, the run must not have a journal yet.
+    """
+    fpath = journal.journal_path(sDir, now)
+    if resume:
+        if not os.path.isfile(fpath):
+            raise Exception('No request journal to resume: {}'.format(fpath))
+        rj = journal.RequestJournal(fpath)
+        url_list = rj.urls('planned')
+        # requests that uFrame did not accept (no outputUrl) are sent again
+        failed = [u for u in rj.urls('submitted')
+                  if 'no_output_url' in (rj.requests[u].get('outputUrl') or 'no_output_url')]
+        print('\nResuming run {}: {} of {} requests have not been sent and {} were not accepted, sending them '
+              'again'.format(now, len(url_list), len(rj.requests), len(failed)))
+        url_list = url_list + failed
+    else:
+        if os.path.isfile(fpath) and journal.has_records(fpath):
+            raise Exception('A request journal already exists for run {}: {} (resume the run, or start a new '
+                            'one)'.format(now, fpath))
+        rj = journal.RequestJournal(fpath)
+        url_list = load_urls(sDir, urls)
+    return rj, url_list
 
-    if 'y' in cont:
-        stime = time.time()
-        summary_file = os.path.join(sDir, 'data_request_summary_{}.csv'.format(now))
-        thredds_urls = []
-        with open(summary_file, 'a') as summary:
-            writer = csv.writer(summary)
-            writer.writerow(['status', 'request_url', 'outputUrl'])
-
-        for i in range(len(url_list)):
-            req = i+1
-            url = url_list[i]
-            print('\nRequest url {} of {}: {}'.format(req, len(url_list), url))
-            session = requests.session()
-            r = session.get(url, auth=(username, token))
 
-            while r.status_code == 400:
-                print('Data request failed')
-                print('Status from uFrame: %s' % r.json()['message']['status'])
-                print('Trying request again in 1 minute')
-                time.sleep(60)
-                print('Re-sending request: %s' % url)
-                r = session.get(url, auth=(username, token))
+def cancel_journal(rj):
+    # close the journal of a run cancelled before anything was sent, removing it if nothing was recorded so that
+    # journal.latest_run does not pick up the empty run
+    rj.close()
+    if not rj.requests and os.path.isfile(rj.fpath):
+        os.remove(rj.fpath)
 
-            status, outputUrl = define_status_outputUrl(r)
 
-            thredds_urls.append(outputUrl)
+def send_all(sDir, url_list, username, token, now, n_workers=5, callback=None, rj=None, retry_wait=60):
+    """
+    Send every request in url_list and write the summary file. callback (optional) is called with each request url
+    and its outputUrl as soon as the request has been accepted, and each request is recorded as submitted in the
+    request journal rj (optional). Rejected requests are re-sent after at most retry_wait seconds. Returns the
+    outputUrls in the order of url_list.
+    """
+    summary_file = os.path.join(sDir, 'data_request_summary_{}.csv'.format(now))
+    thredds_urls = []
+    new_file = not os.path.isfile(summary_file)
 
-            wformat = '%s,%s,%s\n'
-            newline = (status, url, outputUrl)
-            with open(summary_file, 'a') as summary:
-                summary.write(wformat % newline)
+    # responses arrive out of order: hold them until every earlier request is done so the summary rows (and
+    # the returned THREDDS urls) follow the order of url_list
+    completed = dict()
+    wformat = '%s,%s,%s\n'
+    with open(summary_file, 'a') as summary:
+        if new_file:
+            csv.writer(summary).writerow(['status', 'request_url', 'outputUrl'])
+        try:
+            for i, url, r in send_requests(url_list, username, token, n_workers=n_workers, retry_wait=retry_wait):
+                print('\nResponse for request url {} of {}: {}'.format(i + 1, len(url_list), url))
+                completed[i] = define_status_outputUrl(r)
+                metrics.count('requests_failed' if 'no_output_url' in completed[i][1] else 'requests_submitted')
+                if rj:
+                    rj.record(url, 'submitted', completed[i][1])
+                if callback:
+                    callback(url, completed[i][1])
+
+                while len(thredds_urls) in completed:
+                    req = len(thredds_urls)
+                    status, outputUrl = completed.pop(req)
+                    summary.write(wformat % (status, url_list[req], outputUrl))
+                    thredds_urls.append(outputUrl)
+                summary.flush()
+        finally:
+            urls_left = [url_list[x] for x in range(len(thredds_urls), len(url_list)) if x not in completed]
+            if len(urls_left) == 0:
+                urls_left = ['Attempted to send all requests']
+            pd.DataFrame(urls_left).to_csv(os.path.join(sDir, 'urls_not_sent_{}.csv'.format(now)), index=False, header=False)
+
+    return thredds_urls
 
-            u = len(url_list) - (i+1)
-            if u == 0:
-                pd.DataFrame(['Attempted to send all requests']).to_csv(os.path.join(sDir, 'urls_not_sent_{}.csv'.format(now)), index=False, header=False)
-            else:
-                urls_left = url_list[-u:]
-                pd.DataFrame(urls_left).to_csv(os.path.join(sDir, 'urls_not_sent_{}.csv'.format(now)), index=False, header=False)
+
+def main(sDir, urls, username, token, now, n_workers=5, resume=False, retry_wait=60, confirm=True):
+    """
+    Send the data requests and return their outputUrls. With resume=True, the run started at now (e.g. from
+    functions.journal.latest_run) is picked up from its request journal: requests that were never sent are sent, and
+    the outputUrls of all of the run's requests that have not been downloaded yet are returned.
+    """
+    cf.create_dir(sDir)
+    rj, url_list = open_journal(sDir, urls, now, resume)
+    if confirm:
+        cont = input('\nThere are {} requests to send, are you sure you want to continue? y/<n>: '.format(len(url_list))) or 'n'
+    else:
+        print('\nSending {} requests'.format(len(url_list)))
+        cont = 'y'
+
+    if 'y' in cont:
+        stime = time.time()
+        with rj:
+            if not resume:
+                for url in url_list:
+                    rj.record(url, 'planned')
+            thredds_urls = send_all(sDir, url_list, username, token, now, n_workers, rj=rj, retry_wait=retry_wait)
+            if resume:
+                thredds_urls = rj.output_urls(['submitted', 'fulfilled'])
 
         etime = time.time() - stime
         if etime < 60:
@@ -110,6 +299,7 @@ def main(sDir, urls, username, token, now):
         return thredds_urls
 
     else:
+        cancel_journal(rj)
         print('\nCancelling data requests.')
 
 
@@ -119,4 +309,8 @@ if __name__ == '__main__':
     username = 'username'
     token = 'token'
     now = dt.datetime.now().strftime('%Y%m%dT%H%M')
-    main(sDir, urls, username, token, now)
+    n_workers = 5
+    resume = False
+    if resume:
+        now = journal.latest_run(sDir)
+    main(sDir, urls, username, token, now, n_workers, resume)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+@brief: Keeps a local copy of the uFrame sensor inventory (subsite -> node -> sensor) and expands partially-qualified
+reference designators (e.g. GS01SUMO or GI01SUMO-SBD11) against it. The inventory is fetched concurrently, saved in the
+local cache directory and re-used until it is older than ttl, after which prefix lookups cost no network calls.
+
+@usage:
+username: OOI API username
+token: OOI API password
+refdes: string of partially- or fully-qualified reference designators, can be multiple (e.g. 'GS01SUMO, GI01SUMO-SBD11')
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from . import data_request_tools
+import functions.common as cf
+
+SENSOR_INV = cf.M2M_URL + '/api/m2m/12576/sensor/inv/'
+_tries = dict()  # in-memory tries, keyed by the time the inventory was fetched
+
+
+def build_trie(refdes_list):
+    # character trie of reference designators, the '$' key marks the end of a complete reference designator
+    trie = dict()
+    for refdes in refdes_list:
+        node = trie
+        for c in refdes:
+            node = node.setdefault(c, dict())
+        node['$'] = refdes
+    return trie
+
+
+def expand_refdes(trie, prefix):
+    # return all reference designators in the trie that start with prefix, sorted
+    node = trie
+    for c in prefix:
+        node = node.get(c)
+        if node is None:
+            return []
+    matches = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        for k, v in node.items():
+            if k == '$':
+                matches.append(v)
+            else:
+                stack.append(v)
+    return sorted(matches)
+
+
+def fetch_inventory(username, token, session, n_workers=10):
+    """
+    Return the sensor inventory as a dictionary of {subsite: {node: [sensors]}}. The nodes of every subsite, and then
+    the sensors of every node, are requested concurrently.
+    """
+    def get_json(url):
+        r = session.get(url, auth=(username, token))
+        r.raise_for_status()
+        return r.json()
+
+    subsites = get_json(SENSOR_INV)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        nodes = dict(zip(subsites, executor.map(lambda s: get_json(SENSOR_INV + s), subsites)))
+        pairs = [(s, n) for s in subsites for n in nodes[s]]
+        sensors = executor.map(lambda sn: get_json(SENSOR_INV + sn[0] + '/' + sn[1]), pairs)
+        inventory = dict((s, dict()) for s in subsites)
+        for (s, n), sens in zip(pairs, sensors):
+            inventory[s][n] = sens
+    return inventory
+
+
+def get_inventory(username, token, session=None, refresh=False, ttl=7 * 24 * 3600):
+    """
+    Return the sensor inventory (see fetch_inventory) and the time it was fetched. The inventory is read from the
+    local cache unless it is older than ttl seconds or refresh=True.
+    """
+    fpath = os.path.join(cf.cache_dir(), 'sensor_inventory.json')
+    if not refresh and os.path.isfile(fpath):
+        with open(fpath) as f:
+            cached = json.load(f)
+        if time.time() - cached['fetched'] < ttl:
+            return cached['inventory'], cached['fetched']
+
+    if session is None:
+        session = cf.get_session()
+    print('Fetching the sensor inventory')
+    cached = dict(fetched=time.time(), inventory=fetch_inventory(username, token, session))
+    with open(fpath + '.tmp', 'w') as f:
+        json.dump(cached, f)
+    os.replace(fpath + '.tmp', fpath)
+    return cached['inventory'], cached['fetched']
+
+
+def get_trie(username, token, session=None, refresh=False):
+    inventory, fetched = get_inventory(username, token, session, refresh)
+    if fetched not in _tries:
+        _tries.clear()
+        _tries[fetched] = build_trie(refdes_list(inventory))
+    return _tries[fetched]
+
+
+def main(username, token, refdes, session=None, refresh=False):
+    """
+    Expand each of the partially- or fully-qualified reference designators in refdes to the fully-qualified reference
+    designators in the sensor inventory. Returns a sorted list without duplicates.
+    """
+    trie = get_trie(username, token, session, refresh)
+    expanded = set()
+    for i in data_request_tools.format_inputs(refdes):
+        matches = expand_refdes(trie, i)
+        if not matches:
+            if len(i.split('-')) == 4:
+                matches = [i]  # keep fully-qualified reference designators that are no longer in the inventory
+            else:
+                print('No reference designators in the sensor inventory match {}'.format(i))
+        expanded.update(matches)
+    return sorted(expanded)
+
+
+def refdes_list(inventory):
+    return ['-'.join([s, n, sens]) for s in inventory for n in inventory[s] for sens in inventory[s][n]]
+
+
+if __name__ == '__main__':
+    username = 'username'
+    token = 'token'
+    refdes = 'GS01SUMO, GI01SUMO-SBD11'
+    print(main(username, token, refdes))
@@ -8,67 +8,357 @@ Script to download netCDF, provenance, and annotation files from a THREDDS direc
 
 sDir: local directory to which files are saved
 thredds_urls: file or list containing THREDDS directories containing .nc files to download to a local machine.
+n_workers: optional number of files downloaded at once (default 4)
+now: optional timestamp of the run, each request is recorded as fulfilled and downloaded in that run's request journal
+(request_journal_<now>.jsonl) if there is one
+
+The status of all of the data requests is checked at once (see functions.common.wait_for_requests), and requests
+that time out before fulfilling are listed at the end instead of downloaded.
+
+Each download folder keeps a download_manifest.json with the size, remote modification time and sha256 checksum of
+every completed file (files completed during a run are appended to download_manifest.jsonl, which is folded into
+the manifest at the end of the run). Files that are already complete (same size and checksum) are skipped on the
+next run, and interrupted downloads are resumed from their .part file. Downloaded files are added to the dataset
+index in sDir/dataset_index.db (see dataset_index.py).
+
+THREDDS catalogs are parsed as they stream in (including nested sub-catalogs, which are fetched concurrently) and
+are cached per output url. The file sizes and modification times they list are used to skip complete files without
+asking the server again.
 """
 
 
-from xml.dom import minidom
-from urllib.request import urlopen, urlretrieve
+from xml.etree import ElementTree
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import pandas as pd
+import hashlib
+import json
 import os
+import time
 import functions.common as cf
+from functions import journal
+from functions import metrics
+from . import dataset_index
+
+SIZE_UNITS = {'bytes': 1, 'kbytes': 1e3, 'mbytes': 1e6, 'gbytes': 1e9, 'tbytes': 1e12}
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+MANIFEST_LOG = 'download_manifest.jsonl'  # files completed since the manifest was last saved
+_catalogs = dict()  # parsed catalogs, keyed by catalog url
+
+
+def download_file(session, file_url, file_name, last_modified=None, size=None, chunk_size=1024 * 1024):
+    """
+    Stream file_url to file_name in large chunks. A partial download left in file_name.part is resumed with an HTTP
+    Range request (only if the remote file has not changed since). A part file that is not smaller than the remote
+    file is kept only if it has the remote size (from the server's Content-Range, or size), otherwise it is discarded
+    and the whole file is downloaded again. Returns the number of bytes downloaded and the sha256 checksum of the
+    complete file.
+    """
+    part_name = file_name + '.part'
+    checksum = hashlib.sha256()
+    headers = dict()
+    if os.path.isfile(part_name) and last_modified:
+        headers['Range'] = 'bytes={}-'.format(os.path.getsize(part_name))
+        headers['If-Range'] = last_modified
+
+    nbytes = 0
+    with session.get(file_url, headers=headers, stream=True) as r:
+        if r.status_code == 416:  # the partial file reaches the end of the remote file
+            total = r.headers.get('Content-Range', '').rpartition('/')[2]
+            total = int(total) if total.isdigit() else size
+            if total is None or total != os.path.getsize(part_name):
+                print('{}: partial download does not match the remote file, downloading it again'.format(
+                    os.path.basename(file_name)))
+                os.remove(part_name)
+                return download_file(session, file_url, file_name, size=size, chunk_size=chunk_size)
+            mode = 'ab'
+        else:
+            r.raise_for_status()
+            mode = 'ab' if r.status_code == 206 else 'wb'
+        if mode == 'ab':
+            with open(part_name, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    checksum.update(chunk)
+        if r.status_code != 416:
+            with open(part_name, mode) as f:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    checksum.update(chunk)
+                    nbytes += len(chunk)
+    os.replace(part_name, file_name)
+    return nbytes, checksum.hexdigest()
+
+
+def download_files(file_urls, output_dir, session=None, n_workers=4, index_db=None, request_url=None, output_url=None,
+                   remote=None):
+    """
+    Download files to output_dir using n_workers threads that share one pooled keep-alive session. Files recorded
+    as complete in the folder's manifest are skipped. Prints the throughput of each file and of the whole set, and
+    returns the total number of bytes downloaded. If index_db is given, each file is added to that dataset index
+    (see dataset_index.py) as soon as it is complete. remote (optional) maps file urls to their THREDDS catalog entry
+    (see iter_catalog), whose size and modification time are then used instead of asking the server for them.
+    """
+    remote = remote or dict()
+    if session is None:
+        session = cf.get_session(pool_size=n_workers)
+
+    manifest = load_manifest(output_dir)
+    stime = time.time()
+    total_bytes = 0
+    with ThreadPoolExecutor(max_workers=n_workers) as executor, \
+            open(os.path.join(output_dir, MANIFEST_LOG), 'a') as manifest_log:
+        futures = dict()
+        for file_url in file_urls:
+            file_name = os.path.join(output_dir, file_url.split('/')[-1])
+            futures[executor.submit(fetch_file, session, file_url, file_name, manifest.get(os.path.basename(file_name)),
+                                    remote.get(file_url))] = file_name
+        for fut in as_completed(futures):
+            name = os.path.basename(futures[fut])
+            entry, nbytes, etime = fut.result()
+            if index_db:
+                dataset_index.add_files(index_db, [dataset_index.file_record(futures[fut])], request_url, output_url)
+            if entry is None:
+                print('{}: already downloaded, skipping'.format(name))
+                metrics.count('files_skipped')
+                continue
+            total_bytes += nbytes
+            metrics.count('files_downloaded')
+            manifest[name] = entry
+            manifest_log.write(json.dumps(dict(name=name, entry=entry)) + '\n')  # one record per completed file
+            manifest_log.flush()
+            print('{}: {}'.format(name, format_throughput(nbytes, etime)))
+    save_manifest(output_dir, manifest)
+
+    print('Downloaded {} files: {}'.format(len(file_urls), format_throughput(total_bytes, time.time() - stime)))
+    return total_bytes
+
+
+def download_request(sDir, t, session=None, n_workers=4, request_url=None,
+                     server_url=cf.OPENDAP_URL):
+    # Create local folders and download files
+    print('Downloading files')
+    folder = t.split('/')[-2]
+    subsite = folder.split('-')[1]
+    refdes = '-'.join((subsite, folder.split('-')[2], folder.split('-')[3], folder.split('-')[4]))
+    output_dir = os.path.join(sDir, subsite, refdes, folder)
+    cf.create_dir(output_dir)
+
+    catalog_url = t.replace('.html', '.xml')
+    remote = dict()
+    with metrics.stage('thredds_catalog'):
+        for d in get_catalog(catalog_url, session):
+            if d['urlPath'].endswith(('_provenance.json', '_annotations.json', '.nc')):
+                remote['/'.join((server_url, 'thredds/fileServer', d['urlPath']))] = d
+    index_db = os.path.join(sDir, 'dataset_index.db')
+    return download_files(list(remote), output_dir, session, n_workers, index_db, request_url, t, remote)
+
+
+def file_checksum(file_name, chunk_size=1024 * 1024):
+    # sha256 checksum of a local file, as recorded in the manifest
+    checksum = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
 
 
-def get_elements(url, tag_name, attribute_name):
-    """Get elements from an XML file"""
-    usock = urlopen(url)
-    xmldoc = minidom.parse(usock)
-    usock.close()
-    tags = xmldoc.getElementsByTagName(tag_name)
-    attributes=[]
-    for tag in tags:
-        attribute = tag.getAttribute(attribute_name)
-        attributes.append(attribute)
-    return attributes
+def format_throughput(nbytes, etime):
+    mb = nbytes / 1e6
+    return '%.2f MB in %.2f seconds (%.2f MB/s)' % (mb, etime, mb / max(etime, 1e-6))
 
 
-def main(sDir, thredds_urls):
-    server_url = 'https://opendap.oceanobservatories.org'
+def main(sDir, thredds_urls, n_workers=4, now=None):
     cf.create_dir(sDir)
+    rj = None
+    if now and os.path.isfile(journal.journal_path(sDir, now)):
+        rj = journal.RequestJournal(journal.journal_path(sDir, now))
     if type(thredds_urls) == list:
         thredds_list = thredds_urls
+        # the request url of each outputUrl comes from the run's request journal (if there is one)
+        request_urls = [rj.request_urls.get(t) if rj else None for t in thredds_list]
     else:
         thredds_file = pd.read_csv(os.path.join(sDir, thredds_urls))
         thredds_list = thredds_file['outputUrl'].tolist()
+        request_urls = thredds_file['request_url'].tolist()
 
-    for t in thredds_list:
+    # wait for all of the data requests at once, then download the ones that fulfilled
+    fulfilled = cf.wait_for_requests(thredds_list, rj)
+    session = cf.get_session(pool_size=n_workers)
+    not_fulfilled = []
+    for t, request_url in zip(thredds_list, request_urls):
+        if not fulfilled.get(t):
+            not_fulfilled.append(t)
+            continue
         print(t)
+        download_request(sDir, t, session, n_workers, request_url)
+        if rj:
+            rj.record_output(t, 'downloaded')
+
+    if rj:
+        rj.close()
+    if not_fulfilled:
+        print('\n{} data requests were not downloaded because they did not fulfill:'.format(len(not_fulfilled)))
+        for t in not_fulfilled:
+            print(t)
+
+
+def fetch_file(session, file_url, file_name, entry=None, remote=None):
+    """
+    Download a single file unless the local copy matches the manifest entry (size and sha256 checksum) and the remote
+    size and modification time. The remote size and modification time come from the file's THREDDS catalog entry (remote, see
+    iter_catalog) when it has them, otherwise (or to resume a partial download) from a HEAD request. Returns the new
+    manifest entry (None if the file was skipped), the bytes downloaded and the elapsed time.
+    """
+    stime = time.time()
+    remote = remote or dict()
+    modified = remote.get('modified')
+    last_modified = None
+    if modified and remote.get('size') is not None and not os.path.isfile(file_name + '.part'):
+        size = remote['size']
+        size_exact = remote['size_exact']
+    else:
+        r = session.head(file_url, allow_redirects=True)
+        r.raise_for_status()
+        size = int(r.headers.get('Content-Length', -1))
+        size_exact = True
+        last_modified = r.headers.get('Last-Modified')
+
+    if entry and os.path.isfile(file_name):
+        local_size = os.path.getsize(file_name)
+        if size_exact:
+            same_size = entry['size'] == size == local_size
+        else:  # catalog sizes are rounded (e.g. 12.34 Mbytes)
+            same_size = entry['size'] == local_size and abs(local_size - size) <= 1e-3 * size
+        if same_size and ((last_modified and entry.get('last_modified') == last_modified) or
+                          (modified and entry.get('modified') == modified)):
+            if entry.get('sha256') in (None, file_checksum(file_name)):
+                return None, 0, time.time() - stime
+            print('{}: checksum does not match the manifest, downloading it again'.format(os.path.basename(file_name)))
+
+    with metrics.stage('download_file'):
+        nbytes, checksum = download_file(session, file_url, file_name, last_modified,
+                                         size if size_exact and size >= 0 else None)
+    metrics.count('download_bytes', nbytes)
+    entry = dict(size=os.path.getsize(file_name), last_modified=last_modified, modified=modified, sha256=checksum)
+    return entry, nbytes, time.time() - stime
+
+
+def get_catalog(catalog_url, session=None, n_workers=4, refresh=False):
+    """
+    Return the file entries of a THREDDS catalog (see iter_catalog) as a list. The catalog of a fulfilled data
+    request does not change, so once the request's status.txt exists each catalog is parsed once and kept in memory
+    and in the local cache directory (see functions.common.cache_dir) for later runs. The catalog of a request that
+    is still being fulfilled is parsed again every time. refresh=True parses it again.
+    """
+    fpath = os.path.join(cf.cache_dir(), 'thredds_catalogs', hashlib.sha1(catalog_url.encode('utf-8')).hexdigest() + '.json')
+    if not refresh:
+        if catalog_url in _catalogs:
+            return _catalogs[catalog_url]
+        if os.path.isfile(fpath):
+            with open(fpath) as f:
+                _catalogs[catalog_url] = json.load(f)
+            return _catalogs[catalog_url]
+
+    if session is None:
+        session = cf.get_session(pool_size=n_workers)
+    # check that the request has fulfilled before parsing, so every file it lists is already in the catalog
+    fulfilled = session.head(cf.status_url(catalog_url.replace('/catalog.xml', '/catalog.html'))).status_code == 200
+    entries = list(iter_catalog(catalog_url, session, n_workers))
+    if fulfilled:
+        cf.create_dir(os.path.dirname(fpath))
+        with open(fpath + '.tmp', 'w') as f:
+            json.dump(entries, f)
+        os.replace(fpath + '.tmp', fpath)
+        _catalogs[catalog_url] = entries
+    return entries
+
+
+def iter_catalog(catalog_url, session=None, n_workers=4):
+    """
+    Stream the datasets of a THREDDS catalog.xml, yielding dict(urlPath, size, size_exact, modified) for each file as
+    it is parsed, without building the whole document in memory. size is in bytes (None if the catalog does not give
+    it, size_exact is False when the catalog rounded it) and modified is the catalog's modification time. Sub-catalogs
+    (catalogRef) are followed in n_workers threads while the rest of the catalog is parsed.
+    """
+    if session is None:
+        session = cf.get_session(pool_size=n_workers)
+    seen = {catalog_url}
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = set()
+        items = parse_catalog(session, catalog_url)
+        while True:
+            for kind, value in items:
+                if kind == 'file':
+                    yield value
+                elif value not in seen:
+                    seen.add(value)
+                    futures.add(executor.submit(list, parse_catalog(session, value)))
+            if not futures:
+                return
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            items = [item for fut in done for item in fut.result()]
+
+
+def parse_catalog(session, catalog_url):
+    # yield ('file', entry) for each dataset with a urlPath and ('ref', url) for each catalogRef of one catalog.xml
+    with session.get(catalog_url, stream=True) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        for event, elem in ElementTree.iterparse(r.raw, events=('end',)):
+            tag = elem.tag.rsplit('}', 1)[-1]
+            if tag == 'dataset' and elem.get('urlPath'):
+                entry = dict(urlPath=elem.get('urlPath'), size=None, size_exact=False, modified=None)
+                for child in elem:
+                    ctag = child.tag.rsplit('}', 1)[-1]
+                    if ctag == 'dataSize' and child.text:
+                        units = child.get('units', 'bytes').lower()
+                        entry['size'] = int(round(float(child.text) * SIZE_UNITS.get(units, 1)))
+                        entry['size_exact'] = units == 'bytes'
+                    elif ctag == 'date' and child.get('type') == 'modified':
+                        entry['modified'] = child.text
+                yield 'file', entry
+                elem.clear()
+            elif tag == 'catalogRef' and elem.get(XLINK_HREF):
+                yield 'ref', urljoin(catalog_url, elem.get(XLINK_HREF))
+                elem.clear()
+
+
+def load_manifest(output_dir):
+    # the manifest saved by save_manifest, plus the files completed since then (recorded in the manifest log)
+    manifest = dict()
+    manifest_file = os.path.join(output_dir, 'download_manifest.json')
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    log_file = os.path.join(output_dir, MANIFEST_LOG)
+    if os.path.isfile(log_file):
+        with open(log_file) as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:  # last line cut short by an interrupted run
+                    continue
+                manifest[rec['name']] = rec['entry']
+    return manifest
+
 
-        # Check that the data request has been fulfilled
-        cf.check_request_status(t)
-
-        # Create local folders and download files
-        print('Downloading files')
-        folder = t.split('/')[-2]
-        subsite = folder.split('-')[1]
-        refdes = '-'.join((subsite, folder.split('-')[2], folder.split('-')[3], folder.split('-')[4]))
-        output_dir = os.path.join(sDir, subsite, refdes, folder)
-        cf.create_dir(output_dir)
-
-        catalog_url = t.replace('.html', '.xml')
-        files = []
-        datasets = get_elements(catalog_url, 'dataset', 'urlPath')
-        for d in datasets:
-            if d.endswith(('_provenance.json', '_annotations.json', '.nc')):
-                files.append(d)
-        count = 0
-        for f in files:
-            count += 1
-            file_url = '/'.join((server_url, 'thredds/fileServer', f))
-            file_name = '/'.join((output_dir, file_url.split('/')[-1]))
-            urlretrieve(file_url, file_name)
+def save_manifest(output_dir, manifest):
+    """
+    Write the whole manifest once a set of downloads is done, and empty the manifest log that recorded each file as
+    it completed. The manifest is written to a temporary file first so an interrupted run never leaves a truncated
+    manifest.
+    """
+    manifest_file = os.path.join(output_dir, 'download_manifest.json')
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_file + '.tmp', manifest_file)
+    log_file = os.path.join(output_dir, MANIFEST_LOG)
+    if os.path.isfile(log_file):
+        os.remove(log_file)
 
 
 if __name__ == '__main__':
     sDir = '/Users/lgarzio/Documents/OOI'
     thredds_urls = 'data_request_summary_20180910T1200.csv'
-    main(sDir, thredds_urls)
+    n_workers = 4
+    main(sDir, thredds_urls, n_workers)
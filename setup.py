@@ -3,7 +3,8 @@ from setuptools import setup, find_packages
 setup(
     name='data-download',
     version='1.0',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
+    entry_points={'console_scripts': ['ooi-data-download = scripts.cli:main']},
     url='https://github.com/ooi-data-lab/data-download',
     author='Lori Garzio',
     author_email='lgarzio@marine.rutgers.edu',